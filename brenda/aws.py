@@ -14,40 +14,98 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import time, datetime, calendar, urllib2, logging
+import os, time, datetime, calendar, urllib2, collections, threading, logging
 import boto, boto.sqs, boto.s3, boto.ec2
 import boto.utils
 from brenda.error import ValueErrorRetry
 
+# Number of SQS requests made by this process, keyed by action
+sqs_requests = collections.defaultdict(int)
+
+# Maximum number of entries in a single SQS batch request
+SQS_BATCH_SIZE = 10
+
+# Connections and bucket handles, keyed by process, thread, service, region
+# and credential profile.  boto connections must not be shared between
+# threads, and a forked child (such as an upload process) must not reuse
+# the sockets of its parent, so every process and thread gets its own.
+# The entries of threads that have exited are dropped as new ones are added.
+conn_cache = {}
+conn_cache_pid = os.getpid()
+conn_cache_lock = threading.Lock()
+
+def get_cached(key, connect):
+    global conn_cache_pid
+    pid = os.getpid()
+    if pid != conn_cache_pid:
+        # We were forked: forget the connections of the parent without
+        # closing them, the parent is still using their sockets.
+        with conn_cache_lock:
+            if pid != conn_cache_pid:
+                conn_cache.clear()
+                conn_cache_pid = pid
+    key = (threading.current_thread().ident,) + key
+    obj = conn_cache.get(key)
+    if obj is None:
+        obj = connect()
+        with conn_cache_lock:
+            prune_conn_cache()
+            conn_cache[key] = obj
+    return obj
+
+def prune_conn_cache():
+    # Forget the connections of threads that have exited, such as the
+    # workers of a finished upload or download pool.
+    live = set(t.ident for t in threading.enumerate())
+    for key in conn_cache.keys():
+        if key[0] not in live:
+            del conn_cache[key]
+
+def clear_conn_cache():
+    with conn_cache_lock:
+        conn_cache.clear()
+
 def get_s3_conn(conf):
+    def connect():
+        if region:
+            conn = boto.s3.connect_to_region(region, profile_name=profile)
+            if not conn:
+                raise ValueErrorRetry("Could not establish S3 connection to region %r" % (region,))
+        else:
+            conn = boto.connect_s3(profile_name=profile)
+        return conn
+
     region = conf.get('S3_REGION')
-    if region:
-        conn = boto.s3.connect_to_region(region, profile_name=conf.get('CREDENTIAL_PROFILE'))
-        if not conn:
-            raise ValueErrorRetry("Could not establish S3 connection to region %r" % (region,))
-    else:
-        conn = boto.connect_s3(profile_name=conf.get('CREDENTIAL_PROFILE'))
-    return conn
+    profile = conf.get('CREDENTIAL_PROFILE')
+    return get_cached(('s3', region, profile), connect)
 
 def get_sqs_conn(conf):
+    def connect():
+        if region:
+            conn = boto.sqs.connect_to_region(region, profile_name=profile)
+            if not conn:
+                raise ValueErrorRetry("Could not establish SQS connection to region %r" % (region,))
+        else:
+            conn = boto.connect_sqs(profile_name=profile)
+        return conn
+
     region = conf.get('SQS_REGION')
-    if region:
-        conn = boto.sqs.connect_to_region(region, profile_name=conf.get('CREDENTIAL_PROFILE'))
-        if not conn:
-            raise ValueErrorRetry("Could not establish SQS connection to region %r" % (region,))
-    else:
-        conn = boto.connect_sqs(profile_name=conf.get('CREDENTIAL_PROFILE'))
-    return conn
+    profile = conf.get('CREDENTIAL_PROFILE')
+    return get_cached(('sqs', region, profile), connect)
 
 def get_ec2_conn(conf):
+    def connect():
+        if region:
+            conn = boto.ec2.connect_to_region(region, profile_name=profile)
+            if not conn:
+                raise ValueErrorRetry("Could not establish EC2 connection to region %r" % (region,))
+        else:
+            conn = boto.connect_ec2(profile_name=profile)
+        return conn
+
     region = conf.get('EC2_REGION')
-    if region:
-        conn = boto.ec2.connect_to_region(region, profile_name=conf.get('CREDENTIAL_PROFILE'))
-        if not conn:
-            raise ValueErrorRetry("Could not establish EC2 connection to region %r" % (region,))
-    else:
-        conn = boto.connect_ec2(profile_name=conf.get('CREDENTIAL_PROFILE'))
-    return conn
+    profile = conf.get('CREDENTIAL_PROFILE')
+    return get_cached(('ec2', region, profile), connect)
 
 def parse_s3_url(url):
     if url.startswith('s3://'):
@@ -55,11 +113,13 @@ def parse_s3_url(url):
 
 def put_s3_file(bucktup, path, s3name):
     """
-    bucktup is the return tuple of get_s3_output_bucket_name
+    bucktup is the return tuple of get_s3_output_bucket_name.
+    Return the ETag of the uploaded object.
     """
     k = boto.s3.key.Key(bucktup[0])
     k.key = bucktup[1][1] + s3name
     k.set_contents_from_filename(path)
+    return k.etag.strip('"')
 
 def format_s3_url(bucktup, s3name):
     """
@@ -80,10 +140,15 @@ def get_s3_output_bucket_name(conf):
         bn[1] += '/'
     return bn
 
+def get_s3_bucket(conf, name):
+    # only the first lookup of a bucket costs a round trip
+    conn = get_s3_conn(conf)
+    key = ('s3-bucket', conf.get('S3_REGION'), conf.get('CREDENTIAL_PROFILE'), name)
+    return get_cached(key, lambda: conn.get_bucket(name))
+
 def get_s3_output_bucket(conf):
     bn = get_s3_output_bucket_name(conf)
-    conn = get_s3_conn(conf)
-    buck = conn.get_bucket(bn[0])
+    buck = get_s3_bucket(conf, bn[0])
     return buck, bn
 
 def parse_sqs_url(url):
@@ -128,8 +193,64 @@ def write_sqs_queue(string, queue, attributes=None):
     queue.write(m)
 
 def write_batch_sqs_queue(messages, queue):
+    sqs_requests['SendMessageBatch'] += 1
     return queue.write_batch(messages)
 
+def read_batch_sqs_queue(queue, num_messages, visibility_timeout, wait_time):
+    sqs_requests['ReceiveMessage'] += 1
+    return queue.get_messages(num_messages=num_messages, visibility_timeout=visibility_timeout,
+                              wait_time_seconds=wait_time, message_attributes=['All'])
+
+def change_visibility_sqs_message(msg, visibility_timeout):
+    sqs_requests['ChangeMessageVisibility'] += 1
+    msg.change_visibility(visibility_timeout)
+
+def delete_sqs_message(msg):
+    sqs_requests['DeleteMessage'] += 1
+    msg.delete()
+
+def sqs_batches(messages):
+    for i in xrange(0, len(messages), SQS_BATCH_SIZE):
+        yield messages[i:i+SQS_BATCH_SIZE]
+
+def batch_failures(messages, result):
+    """
+    Return the messages of a batch request that SQS reported as failed
+    and that are worth retrying.  Entries that failed through our own
+    fault, such as an expired receipt handle, would fail again.
+    """
+    failed_ids = set()
+    for e in result.errors:
+        logging.warning('SQS batch entry %s failed: %s %s', e['id'], e.get('error_code'), e.get('error_message'))
+        if str(e.get('sender_fault')).lower() != 'true':
+            failed_ids.add(e['id'])
+    return [msg for msg in messages if msg.id in failed_ids]
+
+def change_visibility_batch_sqs_queue(queue, messages, visibility_timeout):
+    """
+    Change the visibility timeout of messages with ChangeMessageVisibilityBatch
+    requests, falling back to a single request for each failed entry.
+    """
+    for batch in sqs_batches(messages):
+        sqs_requests['ChangeMessageVisibilityBatch'] += 1
+        result = queue.change_message_visibility_batch([(msg, visibility_timeout) for msg in batch])
+        for msg in batch_failures(batch, result):
+            change_visibility_sqs_message(msg, visibility_timeout)
+
+def delete_batch_sqs_queue(queue, messages):
+    """
+    Delete messages with DeleteMessageBatch requests, falling back to a
+    single request for each failed entry.
+    """
+    for batch in sqs_batches(messages):
+        sqs_requests['DeleteMessageBatch'] += 1
+        result = queue.delete_message_batch(batch)
+        for msg in batch_failures(batch, result):
+            delete_sqs_message(msg)
+
+def format_sqs_requests():
+    return ', '.join(['%s=%d' % (k, v) for k, v in sorted(sqs_requests.items())])
+
 def get_ec2_instances_from_conn(conn, instance_ids=None, filters=None):
     return conn.get_only_instances(instance_ids=instance_ids,filters=filters)
 
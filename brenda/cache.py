@@ -0,0 +1,227 @@
+# Brenda -- Render farm tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Content-addressed asset cache of a render node.  Task scripts fetch
+# their inputs (scene files, textures, caches) through the brenda-asset
+# command, which keeps one copy of every object in the cache directory,
+# named by its S3 ETag:
+#
+#   ASSET_CACHE_DIR/objects/ETAG : cached objects, read-only
+#   ASSET_CACHE_DIR/locks/ETAG   : flock(2) locks that serialize fetches
+#   ASSET_CACHE_DIR/tmp/         : downloads in progress
+#
+# The name of every file that brenda-asset links or downloads into a
+# directory, normally a task dir, is recorded in the .brenda_inputs file of
+# that directory, so that brenda-node doesn't upload the inputs of a task
+# along with its output.
+#
+# Each fetch costs a HEAD request to learn the current ETag of the URL, so
+# a changed object is never served stale.  Objects are fetched with the
+# parallel downloader, and an interrupted fetch resumes from its partial
+# download in tmp/.  The mtime of an object is its last use, and the least
+# recently used objects are evicted to keep the cache under ASSET_CACHE_SIZE.
+# With ASSET_PEER_PORT set, objects are fetched from the caches of other
+# nodes before S3 (see peers).
+
+import os, time, errno, fcntl, logging
+from brenda import aws, download, peers, utils
+
+GB = 1024 * 1024 * 1024
+
+# partial downloads untouched for this many seconds are removed by evict
+STALE_PARTIAL = 24 * 3600
+
+# record of the input files of a directory
+INPUTS_NAME = '.brenda_inputs'
+
+def parse_asset_url(url):
+    bn = aws.parse_s3_url(url)
+    if not bn or len(bn) != 2 or not bn[1]:
+        raise ValueError("asset URL must be an s3://BUCKET/KEY URL: %s" % (url,))
+    return bn
+
+def record_input(path):
+    # record path as an input before it appears in its directory
+    dirname, name = os.path.split(os.path.abspath(path))
+    with open(os.path.join(dirname, INPUTS_NAME), 'a') as f:
+        f.write(name + '\n')
+
+def read_inputs(dirname):
+    """
+    Return the names of the files of directory dirname that are inputs
+    rather than output: the recorded inputs, their partial downloads and
+    the record itself.
+    """
+    names = set([INPUTS_NAME])
+    try:
+        with open(os.path.join(dirname, INPUTS_NAME)) as f:
+            for line in f:
+                name = line.rstrip('\n')
+                names.update((name, name + '.part', name + '.part.state'))
+    except IOError:
+        pass
+    return names
+
+class Lock(object):
+    """
+    Lock is an exclusive flock(2) on a lock file, shared by all processes
+    of the host.
+    """
+
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR|os.O_CREAT, 0644)
+        flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX|fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.fd, flags)
+        except IOError:
+            os.close(self.fd)
+            self.fd = None
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        os.close(self.fd)
+        self.fd = None
+
+def get_cache_dir(conf):
+    # absolute, so that task scripts running in their task dir share it
+    cache_dir = conf.get('ASSET_CACHE_DIR')
+    if cache_dir:
+        return os.path.realpath(cache_dir)
+    return os.path.join(utils.get_work_dir(conf), 'asset_cache')
+
+class AssetCache(object):
+    def __init__(self, conf, use_peers=True):
+        self.conf = conf
+        self.use_peers = use_peers and peers.get_port(conf) > 0
+        self.dir = get_cache_dir(conf)
+        self.budget = int(float(conf.get('ASSET_CACHE_SIZE', '50')) * GB)
+        for sub in ('objects', 'locks', 'tmp'):
+            path = os.path.join(self.dir, sub)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def object_path(self, name):
+        return os.path.join(self.dir, 'objects', name)
+
+    def lock(self, name, blocking=True):
+        return Lock(os.path.join(self.dir, 'locks', name), blocking)
+
+    def head(self, url):
+        bucket_name, key_name = parse_asset_url(url)
+        key = aws.get_s3_bucket(self.conf, bucket_name).get_key(key_name)
+        if key is None:
+            raise ValueError("asset %s does not exist" % (url,))
+        return key, key.etag.strip('"'), int(key.size)
+
+    def download(self, url, key, path):
+        if self.use_peers and peers.fetch(self.conf, self.dir, url, key.etag.strip('"'), int(key.size), path):
+            return
+        download.download_key(self.conf, key, path)
+
+    def entries(self):
+        """
+        Return (mtime, size, name) of the cached objects, least recently
+        used first.
+        """
+        ret = []
+        objdir = os.path.join(self.dir, 'objects')
+        for name in os.listdir(objdir):
+            try:
+                st = os.stat(os.path.join(objdir, name))
+            except OSError:
+                continue
+            ret.append((st.st_mtime, st.st_size, name))
+        ret.sort()
+        return ret
+
+    def evict(self, needed=0):
+        """
+        Remove least recently used objects until needed more bytes fit
+        in the budget.  Objects that are being fetched or linked are
+        skipped.
+        """
+        entries = self.entries()
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries:
+            if total + needed <= self.budget:
+                break
+            try:
+                with self.lock(name, blocking=False):
+                    logging.info('Evicting asset %s (%d bytes)', name, size)
+                    utils.rm(self.object_path(name))
+                    total -= size
+            except IOError:
+                continue
+        self.remove_stale_partials()
+        if total + needed > self.budget:
+            logging.warning('Asset cache needs %d bytes over its budget of %d bytes',
+                            total + needed - self.budget, self.budget)
+
+    def remove_stale_partials(self):
+        tmpdir = os.path.join(self.dir, 'tmp')
+        now = time.time()
+        for fn in os.listdir(tmpdir):
+            path = os.path.join(tmpdir, fn)
+            try:
+                if now - os.path.getmtime(path) < STALE_PARTIAL:
+                    continue
+                with self.lock(fn.split('.')[0], blocking=False):
+                    logging.info('Removing stale partial download %s', fn)
+                    utils.rm(path)
+            except (IOError, OSError):
+                continue
+
+    def fetch(self, url, dest=None):
+        """
+        Return the path of the cached copy of url, downloading it if
+        it isn't cached yet.  If dest is given, the object is also
+        published to dest (hard linked when possible), while the entry
+        is locked so that it can't be evicted halfway.  Concurrent
+        fetches of the same object on the host download it once.
+        """
+        key, etag, size = self.head(url)
+        name = etag
+        path = self.object_path(name)
+        with self.lock(name):
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                logging.info('Asset cache hit: %s', url)
+                os.utime(path, None)
+            else:
+                logging.info('Asset cache miss: %s (%d bytes)', url, size)
+                self.evict(size)
+                # the lock makes this the only fetch of the object, so
+                # its partial download can be resumed by the next one
+                tmp = os.path.join(self.dir, 'tmp', name)
+                try:
+                    self.download(url, key, tmp)
+                    os.chmod(tmp, 0444)
+                    os.rename(tmp, path)
+                finally:
+                    utils.rm(tmp)
+            if dest is not None:
+                record_input(dest)
+                utils.publish_file(path, dest)
+        return path
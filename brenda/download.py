@@ -0,0 +1,236 @@
+# Brenda -- Render farm tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Parallel download of S3 objects.  An object is split into parts of
+# DOWNLOAD_PART_SIZE that are fetched by concurrent ranged GETs, each
+# written in place into a file preallocated to the size of the object:
+#
+#   PATH.part       : the download in progress
+#   PATH.part.state : the ETag and size of the object, followed by one
+#                     line for every part that is on disk
+#
+# Every GET is conditional on the ETag of the object, so an interrupted
+# download resumes with its missing parts only while the object is
+# unchanged.  The complete file is checked against the ETag and renamed
+# to PATH.
+
+import os, re, time, json, errno, ctypes, hashlib, threading, logging
+from multiprocessing.pool import ThreadPool
+import boto.exception
+from brenda import aws, error, upload, utils
+
+MB = 1024 * 1024
+
+class DownloadConfig(object):
+    def __init__(self, conf):
+        self.threads = max(int(conf.get('DOWNLOAD_THREADS', '16')), 1)
+        self.part_size = max(int(conf.get('DOWNLOAD_PART_SIZE', '32')), 1) * MB
+        self.retries = int(conf.get('DOWNLOAD_RETRIES', conf.get('ERROR_RETRIES', '5')))
+        self.retry_pause = int(conf.get('DOWNLOAD_RETRY_PAUSE', '5'))
+
+def md5_file(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(MB)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def verify_etag(path, etag):
+    """
+    Check a downloaded file against its S3 ETag.  A multipart ETag
+    doesn't record the part size, so it is checked with the smallest
+    whole MB part size that gives the same number of parts, which is
+    what the usual upload tools produce; return None if that check
+    is inconclusive.
+    """
+    m = re.match(r'^([0-9a-f]{32})(?:-(\d+))?$', etag)
+    if not m:
+        return None
+    if not m.group(2):
+        return md5_file(path) == etag
+    n_parts = int(m.group(2))
+    size = os.path.getsize(path)
+    part_size = -(-size // n_parts)
+    part_size = -(-part_size // MB) * MB
+    if upload.compute_etag(path, part_size) == etag:
+        return True
+    return None
+
+def preallocate(fd, size):
+    """
+    Reserve the blocks of a file of size bytes up front, so that parts
+    written out of order don't fragment it and a full disk fails the
+    download at the start.  Filesystems without posix_fallocate(3) get
+    a sparse file.
+    """
+    lc = utils.get_libc()
+    if lc is not None and hasattr(lc, 'posix_fallocate') and size > 0:
+        f = lc.posix_fallocate
+        f.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+        f.restype = ctypes.c_int
+        err = f(fd, 0, size)
+        if err == 0:
+            return
+        if err not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise OSError(err, os.strerror(err))
+    os.ftruncate(fd, size)
+
+class PartState(object):
+    """
+    PartState is the record of the parts of a download that are on
+    disk.  The first line identifies the object, so that the parts of
+    a different version are never reused.
+    """
+
+    def __init__(self, path, etag, size, part_size):
+        self.path = path
+        self.header = dict(etag=etag, size=size, part_size=part_size)
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except IOError:
+            return False
+        try:
+            if json.loads(lines[0]) != self.header:
+                return False
+        except (IndexError, ValueError):
+            return False
+        for line in lines[1:]:
+            try:
+                self.done.add(json.loads(line)['offset'])
+            except (ValueError, KeyError):
+                continue # ignore a partially written last line
+        return True
+
+    def create(self):
+        utils.write_atomic(self.path, json.dumps(self.header, sort_keys=True) + '\n')
+
+    def add(self, offset):
+        with self.lock:
+            self.done.add(offset)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(dict(offset=offset)) + '\n')
+
+def retry_part(dconf, action, desc):
+    # retry a single ranged GET, so that a failure doesn't restart the download
+    def changed(e):
+        if isinstance(e, boto.exception.S3ResponseError) and e.status == 412:
+            return error.ValueErrorRetry("%s changed during the download" % (desc,))
+    return error.retry_part(action, desc, 'Download', dconf.retries, dconf.retry_pause, changed)
+
+def download_key(conf, key, path):
+    """
+    Download the S3 object of boto key (as returned by Bucket.get_key)
+    to path, using parallel ranged GETs.  The parts of an earlier,
+    interrupted download of the same object to path are reused.
+    Return the number of bytes transferred.
+    """
+    dconf = DownloadConfig(conf)
+    bucket_name = key.bucket.name
+    etag = key.etag.strip('"')
+    size = int(key.size)
+    desc = "s3://%s/%s" % (bucket_name, key.name)
+    part_path = path + '.part'
+    state = PartState(part_path + '.state', etag, size, dconf.part_size)
+
+    resumed = state.load() and os.path.exists(part_path)
+    fd = os.open(part_path, os.O_RDWR|os.O_CREAT, 0644)
+    try:
+        if resumed:
+            logging.info('Resuming download of %s, %d of %d parts done', desc,
+                         len(state.done), -(-size // dconf.part_size))
+        else:
+            state.done.clear()
+            os.ftruncate(fd, 0)
+            preallocate(fd, size)
+            state.create()
+    finally:
+        os.close(fd)
+
+    def get_part(offset):
+        length = min(dconf.part_size, size - offset)
+        def action():
+            # a key of the bucket handle of this thread
+            k = aws.get_s3_bucket(conf, bucket_name).new_key(key.name)
+            with open(part_path, 'r+b') as f:
+                f.seek(offset)
+                k.get_contents_to_file(f, headers={
+                    'Range': 'bytes=%d-%d' % (offset, offset + length - 1),
+                    'If-Match': '"%s"' % (etag,),
+                    })
+                if f.tell() != offset + length:
+                    raise error.ValueErrorRetry("short read of %s at offset %d (%d of %d bytes)" % (
+                        desc, offset, f.tell() - offset, length))
+                f.flush()
+                os.fdatasync(f.fileno())
+        logging.debug('Downloading %s bytes %d-%d', desc, offset, offset + length - 1)
+        retry_part(dconf, action, desc)
+        state.add(offset)
+        return length
+
+    parts = [offset for offset in xrange(0, size, dconf.part_size) if offset not in state.done]
+    t = time.time()
+    transferred = 0
+    if parts:
+        pool = ThreadPool(min(dconf.threads, len(parts)))
+        try:
+            for length in pool.imap_unordered(get_part, parts):
+                transferred += length
+        except Exception:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    elapsed = time.time() - t
+
+    # verify before the download becomes visible under path
+    if os.path.getsize(part_path) != size:
+        utils.rm(part_path)
+        utils.rm(state.path)
+        raise error.ValueErrorRetry("size of downloaded %s does not match" % (desc,))
+    verified = verify_etag(part_path, etag)
+    if verified is False:
+        utils.rm(part_path)
+        utils.rm(state.path)
+        raise error.ValueErrorRetry("checksum of downloaded %s does not match ETag %s" % (desc, etag))
+    elif verified is None:
+        logging.warning('Could not verify checksum of %s, only its size', desc)
+    os.rename(part_path, path)
+    utils.rm(state.path)
+    logging.info('Downloaded %s (%d bytes) in %.1fs (%.1f MB/s, %d parts)', desc, transferred, elapsed,
+                 float(transferred) / MB / max(elapsed, 0.001), len(parts))
+    return transferred
+
+def download(conf, url, path):
+    """
+    Download the S3 object of url (s3://BUCKET/KEY) to path.
+    """
+    bn = aws.parse_s3_url(url)
+    if not bn or len(bn) != 2 or not bn[1]:
+        raise ValueError("URL must be an s3://BUCKET/KEY URL: %s" % (url,))
+    key = aws.get_s3_bucket(conf, bn[0]).get_key(bn[1])
+    if key is None:
+        raise ValueError("%s does not exist" % (url,))
+    return download_key(conf, key, path)
@@ -14,7 +14,26 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import time, httplib, socket, logging, sys
+# Retry policies.  error.retry classifies every exception by the policy
+# that applies to it, and sleeps an exponential backoff with full jitter
+# between attempts: a random time between 0 and min(cap, base * 2**attempt),
+# so that a short blip is retried within milliseconds and the nodes of a
+# farm don't retry an outage in lockstep.
+#
+#   throttle   : the service asks us to slow down (HTTP 429, throttling error codes)
+#   connection : connection resets, timeouts and truncated responses
+#   server     : HTTP 5xx errors of the service
+#   error      : other recoverable errors (ValueErrorRetry), such as failed
+#                render tasks, retried with ERROR_PAUSE as the cap
+#
+# Policies can be tuned with RETRY_<POLICY>=BASE,CAP,RETRIES config vars.
+# Failures of a service also trip a per-service circuit breaker: after
+# CIRCUIT_THRESHOLD consecutive failures, further attempts wait for
+# CIRCUIT_RESET seconds, after which one trial attempt closes it again
+# if it succeeds.  The breaker counts the requests made through
+# CircuitBreaker.call, or the attempts of retry with a service.
+
+import time, random, httplib, socket, threading, collections, logging
 import boto.exception
 
 class ValueErrorRetry(ValueError):
@@ -25,36 +44,235 @@ class ValueErrorRetry(ValueError):
     """
     pass
 
-def retry(conf, action):
+class RetryError(Exception):
+    """
+    RetryError is raised by retry when it gives up, with the last
+    exception as cause.
+    """
+
+    def __init__(self, msg, cause=None, attempts=0):
+        Exception.__init__(self, msg)
+        self.cause = cause
+        self.attempts = attempts
+
+class CircuitOpenError(Exception):
+    """
+    CircuitOpenError is raised instead of calling a service whose circuit
+    breaker is open.  remaining is the time until a trial attempt.
+    """
+
+    def __init__(self, service, remaining):
+        Exception.__init__(self, "circuit of %s is open for %.1f more seconds" % (service, remaining))
+        self.service = service
+        self.remaining = remaining
+
+# These are the exception types that justify a retry -- extend this list as needed
+RETRY_EXCEPTIONS = (httplib.IncompleteRead, socket.error, boto.exception.BotoClientError, ValueErrorRetry)
+
+# error codes of throttled AWS requests
+THROTTLE_CODES = frozenset(('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'RequestThrottled',
+                            'SlowDown', 'ProvisionedThroughputExceededException', 'TooManyRequestsException'))
+
+# number of retries by exception type, for the metrics of brenda-node
+retry_counts = collections.defaultdict(int)
+
+class Policy(object):
+    def __init__(self, name, base, cap, retries):
+        self.name = name
+        self.base = base
+        self.cap = cap
+        self.retries = retries
+
+    def delay(self, attempt):
+        return backoff(attempt, self.base, self.cap)
+
+def backoff(attempt, base, cap):
+    # full jitter backoff before retry number attempt (starting at 1)
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+def get_policies(conf):
     n_retries = int(conf.get('ERROR_RETRIES', '5'))
+    policies = dict(
+        throttle=Policy('throttle', 1.0, 60.0, max(n_retries, 10)),
+        connection=Policy('connection', 0.05, 10.0, n_retries),
+        server=Policy('server', 0.5, 30.0, n_retries),
+        error=Policy('error', 1.0, float(conf.get('ERROR_PAUSE', '30')), n_retries),
+        )
+    for name, policy in policies.iteritems():
+        v = conf.get('RETRY_' + name.upper())
+        if v:
+            base, cap, retries = v.split(',')
+            policies[name] = Policy(name, float(base), float(cap), int(retries))
+    return policies
+
+def classify(e):
+    """
+    Return the name of the retry policy of exception e, or None if it
+    isn't worth retrying.
+    """
+    if isinstance(e, boto.exception.BotoServerError):
+        if e.status == 429 or getattr(e, 'error_code', None) in THROTTLE_CODES:
+            return 'throttle'
+        if e.status >= 500:
+            return 'server'
+        return None
+    if isinstance(e, (httplib.HTTPException, socket.error, boto.exception.BotoClientError)):
+        return 'connection'
+    if isinstance(e, ValueErrorRetry):
+        return 'error'
+    return None
+
+class CircuitBreaker(object):
+    """
+    CircuitBreaker stops the threads of a process from calling a service
+    that keeps failing.  It opens after threshold consecutive failures
+    and lets a single trial call through every reset seconds until one
+    succeeds.
+    """
+
+    def __init__(self, service, threshold, reset):
+        self.service = service
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        return self.failures >= self.threshold
+
+    def before(self):
+        with self.lock:
+            if self.failures < self.threshold:
+                return
+            now = time.time()
+            if now < self.open_until:
+                raise CircuitOpenError(self.service, self.open_until - now)
+            # half open: this call is the trial, the others keep waiting
+            self.open_until = now + self.reset
+
+    def success(self):
+        with self.lock:
+            if self.failures >= self.threshold:
+                logging.info('Circuit of %s closed', self.service)
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures == self.threshold:
+                logging.warning('Circuit of %s opened after %d consecutive failures', self.service, self.failures)
+            if self.failures >= self.threshold:
+                self.open_until = time.time() + self.reset
+
+    def call(self, action, *args):
+        """
+        Make a single request action(*args) to the service.  Raise
+        CircuitOpenError instead while the circuit is open.
+        """
+        self.before()
+        try:
+            ret = action(*args)
+        except Exception, e:
+            if classify(e) not in (None, 'error'):
+                self.failure()
+            raise
+        self.success()
+        return ret
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+def get_breaker(conf, service):
+    with breakers_lock:
+        br = breakers.get(service)
+        if br is None:
+            br = breakers[service] = CircuitBreaker(service,
+                                                    int(conf.get('CIRCUIT_THRESHOLD', '5')),
+                                                    float(conf.get('CIRCUIT_RESET', '30')))
+        return br
+
+def retry(conf, action, service=None):
+    """
+    Call action until it succeeds, retrying recoverable errors according
+    to their policy, and return its result.  Raise RetryError once the
+    retries of a policy are used up, or the exception itself if it isn't
+    recoverable.  If service is given, failures of the service count
+    towards its circuit breaker.
+    """
+    policies = get_policies(conf)
     reset_period = int(conf.get('ERROR_RESET', '3600'))
-    error_pause = int(conf.get('ERROR_PAUSE', '30'))
+    breaker = get_breaker(conf, service) if service else None
 
     reset = int(time.time())
-    i = 0
+    attempts = collections.defaultdict(int)
     while True:
         try:
             logging.debug('Trying %s', action)
+            if breaker:
+                breaker.before()
             ret = action()
-        # These are the exception types that justify a retry -- extend this list as needed
-        except (httplib.IncompleteRead, socket.error, boto.exception.BotoClientError, ValueErrorRetry), e:
+        except CircuitOpenError, e:
+            # wait for the trial attempt without counting it as a retry
+            pause = e.remaining + random.uniform(0, 1)
+            logging.info('%s, waiting %.1f seconds', e, pause)
+            time.sleep(pause)
+            continue
+        except Exception, e:
+            name = classify(e)
+            if name is None:
+                raise
+            if breaker and name != 'error':
+                breaker.failure()
             now = int(time.time())
             if now > reset + reset_period:
                 logging.info('Resetting retry period after %s seconds', reset_period)
-                i = 0
+                attempts.clear()
                 reset = now
-            i += 1
-            logging.warning('Retry %d/%d - %s', i, n_retries, e)
-            if i < n_retries:
-                logging.info('Waiting %d seconds before retrying', error_pause)
-                time.sleep(error_pause)
-            else:
-                logging.critical("Giving up after %d retries. Exiting...", n_retries, exc_info=1)
-                sys.exit(1)
-
+            policy = policies[name]
+            attempts[name] += 1
+            i = attempts[name]
+            retry_counts[e.__class__.__name__] += 1
+            logging.warning('Retry %d/%d (%s) - %s', i, policy.retries, name, e)
+            if i >= policy.retries:
+                logging.critical("Giving up after %d retries", policy.retries, exc_info=1)
+                raise RetryError("giving up after %d retries: %s" % (policy.retries, e), e, i)
+            pause = policy.delay(i)
+            logging.info('Waiting %.2f seconds before retrying', pause)
+            time.sleep(pause)
         else:
+            if breaker:
+                breaker.success()
             return ret
 
+# first backoff of a failed part request, doubled up to the pause of the transfer
+PART_RETRY_BASE = 0.1
+
+def retry_part(action, desc, verb, retries, pause, check=None):
+    """
+    Retry a single request of a parallel transfer (a whole file or one
+    part of it), so that a failure doesn't restart the entire transfer.
+    verb names the transfer in the log.  check(e) may return an exception
+    to raise in place of e, without retrying it.
+    """
+    i = 0
+    while True:
+        try:
+            return action()
+        except Exception, e:
+            if check is not None:
+                exc = check(e)
+                if exc is not None:
+                    raise exc
+            if classify(e) is None:
+                raise
+            i += 1
+            retry_counts[e.__class__.__name__] += 1
+            logging.warning('%s of %s failed, retry %d/%d - %s', verb, desc, i, retries, e)
+            if i >= retries:
+                raise
+            time.sleep(backoff(i, PART_RETRY_BASE, pause))
+
 def handle_dry_run(e):
     if e.error_code == 'DryRunOperation':
         logging.warning(e.message)
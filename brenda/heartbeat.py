@@ -0,0 +1,180 @@
+# Brenda -- Render farm tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Fleet telemetry.  Every brenda-node periodically publishes a small JSON
+# heartbeat, named after its instance ID, to the store selected by the
+# scheme of the HEARTBEAT_URL config var:
+#
+#   s3://BUCKET/PREFIX : objects under an S3 prefix
+#   file:///PATH       : files in a local (or shared) directory, for testing
+#
+# brenda-tool reads the heartbeats of the whole fleet in a single listing
+# pass instead of running a command on every instance over ssh.
+
+import os, time, json, socket, threading, logging
+from multiprocessing.pool import ThreadPool
+from brenda import aws, utils
+
+# number of concurrent requests used to read heartbeats from S3
+READ_THREADS = 32
+
+def get_interval(conf):
+    return int(conf.get('HEARTBEAT_INTERVAL', '60'))
+
+def get_store(conf):
+    """
+    Return the heartbeat store of HEARTBEAT_URL, or None if heartbeats
+    aren't configured.
+    """
+    url = conf.get('HEARTBEAT_URL')
+    if not url:
+        return None
+    if url.startswith('file://'):
+        return DirStore(url[len('file://'):])
+    if url.startswith('s3://'):
+        return S3Store(conf, url)
+    raise ValueError("HEARTBEAT_URL must be an s3:// or file:/// URL")
+
+def parse(name, data):
+    try:
+        return json.loads(data)
+    except ValueError:
+        logging.warning('Ignoring malformed heartbeat %s', name)
+
+class DirStore(object):
+    def __init__(self, path):
+        if not path:
+            raise ValueError("HEARTBEAT_URL must be a file:///PATH URL")
+        self.path = os.path.realpath(path)
+
+    def put(self, name, data):
+        if not os.path.isdir(self.path):
+            utils.makedirs(self.path)
+        utils.write_atomic(os.path.join(self.path, name + '.json'), data)
+
+    def get_all(self):
+        ret = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return ret
+        for fn in names:
+            if fn.endswith('.json'):
+                try:
+                    with open(os.path.join(self.path, fn)) as f:
+                        hb = parse(fn, f.read())
+                except IOError:
+                    continue # deleted since the listing, e.g. by a prune
+                if hb:
+                    ret.append(hb)
+        return ret
+
+class S3Store(object):
+    def __init__(self, conf, url):
+        self.conf = conf
+        bn = aws.parse_s3_url(url)
+        self.bucket_name = bn[0]
+        self.prefix = bn[1] if len(bn) > 1 else ''
+        if self.prefix and not self.prefix.endswith('/'):
+            self.prefix += '/'
+
+    def bucket(self):
+        # bucket handles are cached per thread
+        return aws.get_s3_bucket(self.conf, self.bucket_name)
+
+    def put(self, name, data):
+        k = self.bucket().new_key(self.prefix + name + '.json')
+        k.set_contents_from_string(data, headers={'Content-Type': 'application/json'})
+
+    def get_all(self):
+        def get(key_name):
+            key = self.bucket().get_key(key_name)
+            if key is None:
+                return None # deleted since the listing, e.g. by a prune
+            return parse(key_name, key.get_contents_as_string())
+
+        key_names = [k.name for k in self.bucket().list(prefix=self.prefix) if k.name.endswith('.json')]
+        if not key_names:
+            return []
+        pool = ThreadPool(min(READ_THREADS, len(key_names)))
+        try:
+            return [hb for hb in pool.map(get, key_names) if hb]
+        finally:
+            pool.close()
+            pool.join()
+
+def is_alive(hb, conf, now=None):
+    # a node is alive until it publishes its final heartbeat, or
+    # misses a few in a row
+    if now is None:
+        now = time.time()
+    return hb.get('running') and now - hb.get('time', 0) < 3 * get_interval(conf)
+
+def get_heartbeats(conf):
+    """
+    Return a dict of the heartbeats of the fleet, keyed by node ID, or
+    None if heartbeats aren't configured.
+    """
+    store = get_store(conf)
+    if store is None:
+        return None
+    t = time.time()
+    heartbeats = dict([(hb.get('id'), hb) for hb in store.get_all()])
+    logging.debug('Read %d heartbeats in %.1fs', len(heartbeats), time.time() - t)
+    return heartbeats
+
+def get_node_id(instance_id=None):
+    return instance_id or socket.gethostname()
+
+class Publisher(object):
+    """
+    Publisher publishes the heartbeat of a node from a daemon thread
+    every HEARTBEAT_INTERVAL seconds, so that a slow store never holds
+    up the task loop.  state_fn returns a dict of the node state.
+    """
+
+    def __init__(self, conf, store, node_id, state_fn):
+        self.store = store
+        self.node_id = node_id
+        self.state_fn = state_fn
+        self.interval = get_interval(conf)
+        self.start_time = int(time.time())
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def publish(self, running=True):
+        try:
+            hb = self.state_fn()
+            hb.update(id=self.node_id, time=int(time.time()), start_time=self.start_time, running=running)
+            self.store.put(self.node_id, json.dumps(hb, sort_keys=True))
+        except Exception, e:
+            logging.warning('Failed publishing heartbeat: %s', e)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.publish()
+
+    def start(self):
+        self.publish()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.publish(running=False)
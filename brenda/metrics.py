@@ -0,0 +1,257 @@
+# Brenda -- Render farm tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Per-task metrics of brenda-node.  Every finished (or failed) task
+# appends one JSON line to a rotating file in the work dir:
+#
+#   time     : completion timestamp
+#   task     : task ID and script name
+#   receive  : duration of the queue receive that delivered the task
+#   queued   : time the task spent in the prefetch buffer
+#   setup    : time to create the task dir and write the script
+#   prepare  : wall clock time of the prepare phase of the script, if any
+#   render   : wall clock time of the render script
+#   cpu      : user+system CPU time of the render script and its children
+#   upload   : time from the end of the render to the end of the upload
+#   files    : number of files committed
+#   bytes    : number of bytes committed
+#   exit     : exit status of the render script
+#   job, start, end, step, subframes : job name and frame range of the task,
+#              if it was pushed with them (see sizing)
+#
+# Rolling aggregates over the most recent tasks are kept in task_stats.
+#
+# The same measurements, along with the queue request and retry counts
+# and the state of the render slots, can also be scraped from an HTTP
+# endpoint in the Prometheus text format (see MetricsServer).
+
+import os, time, json, threading, collections, logging, logging.handlers
+import BaseHTTPServer
+from brenda import aws, error, utils
+
+METRICS_NAME = 'task_metrics'
+STATS_NAME = 'task_stats'
+
+# fields of the records that are aggregated in task_stats
+STATS_FIELDS = ('receive', 'queued', 'setup', 'prepare', 'render', 'cpu', 'upload', 'bytes')
+
+def percentile(values, p):
+    # nearest-rank percentile of a sorted list
+    if not values:
+        return None
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+# Prometheus text format exposition
+
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+UPLOAD_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in sorted(labels.iteritems())),)
+
+def format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, {}, self.value
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        for bound, n in zip(self.buckets, counts):
+            yield self.name + '_bucket', {'le': format_value(bound)}, n
+        yield self.name + '_sum', {}, total
+        yield self.name + '_count', {}, count
+
+class Callback(object):
+    """
+    Callback is a gauge or counter whose value is read when the
+    metrics are scraped.  fn returns a number, or a list of
+    (labels, value) tuples.
+    """
+
+    def __init__(self, name, help, type, fn):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.fn = fn
+
+    def samples(self):
+        v = self.fn()
+        if isinstance(v, list):
+            for labels, value in v:
+                yield self.name, labels, value
+        else:
+            yield self.name, {}, v
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for m in self.metrics:
+            lines.append('# HELP %s %s' % (m.name, m.help))
+            lines.append('# TYPE %s %s' % (m.name, m.type))
+            try:
+                for name, labels, value in m.samples():
+                    lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+            except Exception:
+                logging.exception('Failed collecting metric %s', m.name)
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+tasks_completed = REGISTRY.add(Counter('brenda_tasks_completed_total', 'Number of tasks rendered and uploaded'))
+tasks_failed = REGISTRY.add(Counter('brenda_tasks_failed_total', 'Number of render tasks that exited with an error'))
+render_seconds = REGISTRY.add(Histogram('brenda_render_duration_seconds', 'Wall clock time of render tasks', DURATION_BUCKETS))
+upload_seconds = REGISTRY.add(Histogram('brenda_upload_duration_seconds', 'Time from the end of a render to the end of its upload', UPLOAD_BUCKETS))
+upload_bytes = REGISTRY.add(Counter('brenda_upload_bytes_total', 'Number of bytes committed to OUTPUT_URL'))
+upload_files = REGISTRY.add(Counter('brenda_upload_files_total', 'Number of files committed to OUTPUT_URL'))
+REGISTRY.add(Callback('brenda_queue_requests_total', 'Number of work queue requests by action', 'counter',
+                      lambda: [({'action': k}, v) for k, v in sorted(dict(aws.sqs_requests).items())]))
+REGISTRY.add(Callback('brenda_retries_total', 'Number of retried operations, including those of upload processes, by exception type', 'counter',
+                      lambda: [({'exception': k}, v) for k, v in sorted(dict(error.retry_counts).items())]))
+REGISTRY.add(Callback('brenda_circuit_open', 'Whether the circuit breaker of a service is open', 'gauge',
+                      lambda: [({'service': k}, int(v.is_open())) for k, v in sorted(dict(error.breakers).items())]))
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # don't let a stalled client hold the server forever
+    timeout = 10
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = REGISTRY.expose()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Metrics request from %s: %s', self.client_address[0], format % args)
+
+class MetricsServer(utils.HTTPServer):
+    """
+    MetricsServer serves REGISTRY on a daemon thread, so that scrapes
+    never block the task loop.
+    """
+
+    def start(self):
+        utils.HTTPServer.start(self)
+        logging.info('Serving metrics on http://%s:%d/metrics', *self.server_address)
+
+class TaskRecorder(object):
+    """
+    TaskRecorder writes the metrics records of brenda-node.  Records are
+    written through a dedicated logger with a RotatingFileHandler, and
+    the aggregates are computed over an in-memory window, so recording
+    a task costs two small file writes.
+    """
+
+    def __init__(self, conf, work_dir):
+        self.stats_path = os.path.join(work_dir, STATS_NAME)
+        self.window = collections.deque(maxlen=int(conf.get('TASK_METRICS_WINDOW', '100')))
+        self.start_time = time.time()
+        self.completed = 0
+        self.failed = 0
+
+        handler = logging.handlers.RotatingFileHandler(
+            os.path.join(work_dir, METRICS_NAME),
+            maxBytes=int(float(conf.get('TASK_METRICS_SIZE', '10')) * 1024 * 1024),
+            backupCount=int(conf.get('TASK_METRICS_BACKUPS', '5')))
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger = logging.getLogger('brenda.task_metrics')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        for h in list(self.logger.handlers):
+            self.logger.removeHandler(h)
+            h.close()
+        self.logger.addHandler(handler)
+
+    def record(self, rec):
+        rec['time'] = round(time.time(), 3)
+        self.logger.info(json.dumps(rec, sort_keys=True))
+        if rec.get('exit') == 0:
+            self.completed += 1
+            self.window.append(rec)
+            tasks_completed.inc()
+            upload_seconds.observe(rec['upload'])
+            upload_bytes.inc(rec['bytes'])
+            upload_files.inc(rec['files'])
+        else:
+            self.failed += 1
+            tasks_failed.inc()
+        render_seconds.observe(rec['render'])
+        utils.write_atomic(self.stats_path, json.dumps(self.stats(), sort_keys=True, indent=1, separators=(',', ': ')) + '\n')
+
+    def stats(self):
+        recs = list(self.window)
+        stats = dict(completed=self.completed, failed=self.failed, window=len(recs))
+
+        # throughput over the window, or since startup if it has a single task
+        if len(recs) >= 2 and recs[-1]['time'] > recs[0]['time']:
+            rate = (len(recs) - 1) * 3600.0 / (recs[-1]['time'] - recs[0]['time'])
+        else:
+            rate = self.completed * 3600.0 / max(time.time() - self.start_time, 1.0)
+        stats['tasks_per_hour'] = round(rate, 2)
+
+        for field in STATS_FIELDS:
+            values = sorted(rec[field] for rec in recs if rec.get(field) is not None)
+            stats[field] = dict(p50=percentile(values, 50), p95=percentile(values, 95))
+        return stats
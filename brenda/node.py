@@ -14,8 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, sys, signal, subprocess, multiprocessing, stat, time, logging
-from brenda import aws, utils, error
+import os, re, sys, signal, subprocess, multiprocessing, stat, time, logging
+from brenda import aws, upload, utils, error, workqueue, sizing, metrics, heartbeat, cache, peers, spot
 
 class State(object):
     pass
@@ -25,44 +25,123 @@ class State(object):
 # so add some methods to make them consistent.
 
 class Subprocess(subprocess.Popen):
+    rusage = None
+
     def stop(self):
         self.terminate()
         return self.wait()
 
+    def poll(self):
+        # reap the process with wait4(2) to get its resource usage
+        return self._internal_poll(_waitpid=self.wait4)
+
+    def wait4(self, pid, options):
+        pid, sts, self.rusage = os.wait4(pid, options)
+        return pid, sts
+
 class Multiprocess(multiprocessing.Process):
+    # read end of the pipe on which the process sends its retry counts
+    retries = None
+
     def stop(self):
         if self.is_alive():
             self.terminate()
             self.join()
+        self.collect_retries()
         return self.exitcode
 
     def poll(self):
+        if self.exitcode is not None:
+            self.collect_retries()
         return self.exitcode
 
-def start_upload_process(opts, args, conf, task):
-    p = Multiprocess(target=s3_upload_process, args=(opts, args, conf, task))
+    def collect_retries(self):
+        # add the retries of the process to the metrics of brenda-node
+        if self.retries is not None:
+            try:
+                if self.retries.poll():
+                    for name, n in self.retries.recv().iteritems():
+                        error.retry_counts[name] += n
+            except (EOFError, IOError):
+                pass
+            self.retries.close()
+            self.retries = None
+
+def start_upload_process(opts, args, conf, task, render_done=None):
+    r, w = multiprocessing.Pipe(False)
+    p = Multiprocess(target=s3_upload_process, args=(opts, args, conf, task, render_done, w))
+    p.retries = r
     p.start()
+    w.close()
     return p
 
-def s3_upload_process(opts, args, conf, task):
-    def do_s3_upload():
-        bucktup = aws.get_s3_output_bucket(conf)
+def s3_upload_process(opts, args, conf, task, render_done=None, retries=None):
+    """
+    Upload the output of a render task.  If render_done is given, the
+    upload starts while the task is still rendering: each frame is
+    uploaded once it is closed and stable, and the remaining files are
+    flushed when render_done is set.  The retry counts of the upload
+    are sent to brenda-node on the retries connection before exit.
+    """
+    def get_files():
+        files = []
+        inputs = cache.read_inputs(task.outdir)
         for dirpath, dirnames, filenames in os.walk(task.outdir):
             for f in filenames:
-                # Skip uploading task script
-                if f == task.script_name:
+                # Skip uploading task script and the inputs fetched by brenda-asset
+                if f == task.script_name or f in inputs:
                     continue
-                path = os.path.join(dirpath, f)
-                logging.info('Uploading %s to %s', f, aws.format_s3_url(bucktup, f))
-                aws.put_s3_file(bucktup, path, f)
+                files.append((os.path.join(dirpath, f), f))
             break
+        return files
+
+    def do_s3_upload():
+        # Upload requests are retried individually by upload_files.  If the
+        # upload still fails, or a previous upload process was interrupted, a
+        # retry only sends files missing from the manifest, after checking
+        # whether they made it to the bucket anyway.
+        attempts[0] += 1
+        check_remote = attempts[0] > 1 or resumed
+        upload.commit_files(conf, get_files(), manifest, check_remote=check_remote)
+
+    def do_s3_stream():
+        watcher = upload.DirWatcher(task.outdir, stable_time, (task.script_name,))
+        try:
+            while not render_done.is_set():
+                watcher.wait(1)
+                inputs = cache.read_inputs(task.outdir)
+                files = [(os.path.join(task.outdir, f), f) for f in watcher.stable_files() if f not in inputs]
+                if files:
+                    upload.commit_files(conf, files, manifest)
+                    if stream_delete:
+                        for path, f in files:
+                            if f in manifest.entries:
+                                utils.rm(path)
+        finally:
+            watcher.close()
+
+    # don't run the signal handler of brenda-node when we are stopped
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
+    # only count the retries of this process, brenda-node has its own
+    error.retry_counts.clear()
+
+    attempts = [0]
+    manifest = upload.Manifest(task.manifest, upload.UploadConfig(conf).part_size)
+    resumed = len(manifest.entries) > 0
+    stable_time = int(conf.get('STREAM_UPLOAD_STABLE', '5'))
+    stream_delete = int(conf.get('STREAM_UPLOAD_DELETE', '0'))
+    status = 0
     try:
+        if render_done is not None:
+            error.retry(conf, do_s3_stream)
         error.retry(conf, do_s3_upload)
     except Exception:
-        logging.exception('Upload to S3 failed')
-        sys.exit(1)
-    sys.exit(0)
+        logging.exception('Upload to %s failed', conf.get('OUTPUT_URL'))
+        status = 1
+    if retries is not None:
+        retries.send(dict(error.retry_counts))
+    sys.exit(status)
 
 def run_tasks(opts, args, conf):
     def write_done_file():
@@ -84,7 +163,66 @@ def run_tasks(opts, args, conf):
         utils.write_atomic(os.path.join(work_dir, 'task_count'), "%d\n" % (task_count,))
 
         # timestamp of completion of last task
-        utils.write_atomic(os.path.join(work_dir, 'task_last'), "%d\n" % (time.time(),))
+        local.task_last = int(time.time())
+        utils.write_atomic(os.path.join(work_dir, 'task_last'), "%d\n" % (local.task_last,))
+
+    def heartbeat_state():
+        # called from the heartbeat thread, so only take snapshots of the state
+        tasks = []
+        for slot in list(local.slots):
+            task = slot.task_render
+            if task is not None and task.start_time is not None:
+                try:
+                    # output files only, not the task script or its inputs
+                    inputs = cache.read_inputs(task.outdir)
+                    n_files = len([f for f in os.listdir(task.outdir) if f not in inputs]) - 1
+                except (OSError, TypeError):
+                    n_files = 0
+                tasks.append(dict(slot=slot.id, task=task.id, script=task.script_name,
+                                  elapsed=int(time.time() - task.start_time), files=n_files))
+        st = os.statvfs(work_dir)
+        return dict(task_count=local.task_count, task_last=local.task_last, tasks=tasks,
+                    prefetched=len(local.prefetch) + len(local.prepared), free_disk=st.f_bavail * st.f_frsize,
+                    interrupted=local.interrupted,
+                    tasks_per_hour=recorder.stats()['tasks_per_hour'])
+
+    def render_finished(task, proc):
+        task.render_end = time.time()
+        task.metrics['render'] = round(task.render_end - task.start_time, 3)
+        if proc.rusage is not None:
+            task.metrics['cpu'] = round(proc.rusage.ru_utime + proc.rusage.ru_stime, 3)
+        task.metrics['exit'] = task.retcode
+        if task.retcode != 0:
+            recorder.record(task.metrics)
+
+    def task_failed(task, name, errtxt):
+        # Return the task of a failed render, upload or prepare phase to the queue,
+        # without disturbing the other slots.  Only a run of failures,
+        # which suggests the node itself is broken, fails the task loop.
+        logging.error('%s, returning it to the work queue', errtxt)
+        cleanup(task, name)
+        local.task_failures += 1
+        if local.task_failures >= max_task_failures:
+            raise error.ValueErrorRetry(errtxt)
+
+    def render_failed(slot, task):
+        slot.task_render = None
+        task_failed(task, 'render', "Render task \"{} #{}\" exited with status code {}".format(
+            task.script_name, task.id, task.retcode))
+
+    def upload_failed(slot, task):
+        slot.task_upload = None
+        task_failed(task, 'upload', "Upload task #{} exited with status code {}".format(
+            task.id, task.retcode))
+
+    def upload_finished(task):
+        task.metrics['upload'] = round(time.time() - task.render_end, 3)
+        # the manifest has every file committed by the upload, even
+        # streamed ones that were already deleted
+        manifest = upload.Manifest(task.manifest, 0)
+        task.metrics['files'] = len(manifest.entries)
+        task.metrics['bytes'] = sum(e['size'] for e in manifest.entries.itervalues())
+        recorder.record(task.metrics)
 
     def signal_handler(signal, frame):
         logging.warning("Exit on signal %r", signal)
@@ -92,11 +230,90 @@ def run_tasks(opts, args, conf):
         sys.exit(1)
 
     def cleanup_all():
-        tasks = (local.task_render, local.task_upload)
-        local.task_render = local.task_upload = None
+        # delete messages of completed tasks before anything is returned
+        try:
+            flush_deletes()
+        except Exception:
+            logging.exception('Failed deleting SQS messages of completed tasks')
+
+        # immediately return prefetched, prepared and in-flight tasks back to work queue
+        msgs = local.prefetch
+        local.prefetch = []
+        prepared = local.prepared
+        local.prepared = []
+        for task in prepared:
+            if task.msg is not None:
+                msgs.append(task.msg)
+                task.msg = None
+        tasks = []
+        for slot in local.slots:
+            tasks.extend((slot.task_render, slot.task_upload))
+            slot.task_render = slot.task_upload = None
+        for task in tasks:
+            if task and task.msg is not None:
+                logging.debug('Returning render task \"%s #%s\" back to SQS queue', task.script_name, task.id)
+                msgs.append(task.msg)
+                task.msg = None
+        for q, group in workqueue.group_by_queue(msgs):
+            try:
+                breaker.call(aws.change_visibility_batch_sqs_queue, q, group, 0)
+            except Exception:
+                logging.exception('Failed changing SQS message visibility of %d tasks', len(group))
+
         for i, task in enumerate(tasks):
-            name = task_names[i]
+            name = task_names[i % 2]
             cleanup(task, name)
+        for task in prepared:
+            cleanup(task, 'prepare')
+
+    def hand_back_tasks():
+        # Return the messages of everything that isn't rendered yet to the
+        # queue in batches: prefetched and prepared tasks and running renders.
+        # Finished renders keep their messages until they are uploaded.
+        msgs = local.prefetch
+        local.prefetch = []
+        tasks = local.prepared
+        local.prepared = []
+        for slot in local.slots:
+            task = slot.task_render
+            if task and task.proc is not None:
+                slot.task_render = None
+                tasks.append(task)
+        for task in tasks:
+            if task.msg is not None:
+                msgs.append(task.msg)
+                task.msg = None
+        logging.info('Returning %d tasks to the work queue', len(msgs))
+        for q, group in workqueue.group_by_queue(msgs):
+            try:
+                breaker.call(aws.change_visibility_batch_sqs_queue, q, group, 0)
+            except Exception:
+                logging.exception('Failed changing SQS message visibility of %d tasks', len(group))
+        for task in tasks:
+            cleanup(task, 'render')
+
+    def manifest_path(msg):
+        # keyed by the message ID, which (unlike the receipt handle) stays
+        # the same when the task is delivered again
+        return os.path.join(manifest_dir, "{}_{}".format(msg.level.name, msg.id))
+
+    def flush_deletes():
+        msgs = local.pending_delete
+        local.pending_delete = []
+        if msgs:
+            logging.debug('Deleting %d completed tasks from SQS', len(msgs))
+            for q, group in workqueue.group_by_queue(msgs):
+                breaker.call(aws.delete_batch_sqs_queue, q, group)
+                # the upload manifest is kept until the task is gone for good
+                for msg in group:
+                    utils.rm(manifest_path(msg))
+
+    def flush_reasserts(msgs):
+        if msgs:
+            logging.debug('Reasserting %d tasks with SQS', len(msgs))
+            for q, group in workqueue.group_by_queue(msgs):
+                breaker.call(aws.change_visibility_batch_sqs_queue, q, group, visibility_timeout)
+            logging.debug('SQS requests: %s', aws.format_sqs_requests())
 
     def cleanup(task, name):
         if task:
@@ -105,7 +322,7 @@ def run_tasks(opts, args, conf):
                     logging.debug('Returning render task \"%s #%s\" back to SQS queue', task.script_name, task.id)
                     msg = task.msg
                     task.msg = None
-                    msg.change_visibility(0) # immediately return task back to work queue
+                    breaker.call(aws.change_visibility_sqs_message, msg, 0) # immediately return task back to work queue
                 except Exception:
                     logging.exception('Failed changing SQS message visibility of task %s', name)
             if task.proc is not None:
@@ -116,6 +333,14 @@ def run_tasks(opts, args, conf):
                     proc.stop()
                 except Exception:
                     logging.exception('Failed stopping processing of task %s', name)
+            if task.stream is not None:
+                try:
+                    logging.debug('Stopping streaming upload of render task: %s #%s', task.script_name, task.id)
+                    stream = task.stream
+                    task.stream = None
+                    stream.stop()
+                except Exception:
+                    logging.exception('Failed stopping streaming upload of task %s', name)
             if task.outdir is not None:
                 try:
                     outdir = task.outdir
@@ -124,187 +349,388 @@ def run_tasks(opts, args, conf):
                 except Exception:
                     logging.exception('Failed removing task dir %s', task.outdir)
 
+    def prepare_task():
+        # initialize render task object
+        task = State()
+        task.msg = None
+        task.proc = None
+        task.retcode = None
+        task.outdir = None
+        task.id = 0
+        task.script_name = None
+        task.stream = None
+        task.stream_done = None
+        task.start_time = None
+        task.render_end = None
+
+        # Get a task from the prefetch buffer.  This is normally
+        # a short script that renders one or more frames.
+        if not local.prefetch:
+            return None
+        task.msg = local.prefetch.pop(0)
+        setup_time = time.time()
+
+        # assign an ID to task
+        local.task_id_counter += 1
+        task.id = local.task_id_counter
+        task.script_name = task.msg.message_attributes['script_name']['string_value']
+        task.manifest = manifest_path(task.msg)
+        task.metrics = dict(task=task.id, script=task.script_name,
+                            receive=round(task.msg.receive_latency, 3),
+                            queued=round(setup_time - task.msg.received, 3))
+        # the frame range relates the render time to frames, for adaptive task sizing
+        task.metrics.update(sizing.frame_attributes(task.msg))
+
+        # create output directory
+        task.outdir = os.path.join(work_dir, "{}_out_{}".format(task.script_name, task.id))
+        utils.rmtree(task.outdir)
+        utils.mkdir(task.outdir)
+
+        # get the task script
+        script = task.msg.get_body()
+
+        # cd to output directory, where we will run render task from
+        with utils.Cd(task.outdir):
+            # write script file and make it executable
+            script_fn = "./{}".format(task.script_name)
+            with open(script_fn, 'w') as f:
+                f.write(script)
+            st = os.stat(script_fn)
+            os.chmod(script_fn, st.st_mode | (stat.S_IEXEC|stat.S_IXGRP|stat.S_IXOTH))
+        task.metrics['setup'] = round(time.time() - setup_time, 3)
+
+        # Run the prepare phase of the script (e.g. downloading its
+        # inputs) right away, while the slot it will render in may
+        # still be busy.
+        task.prepare_start = None
+        if re_prepare.search(script):
+            logging.info('Preparing render task \"%s #%d\"', task.script_name, task.id)
+            with utils.Cd(task.outdir):
+                task.prepare_start = time.time()
+                task.proc = Subprocess([script_fn], env=dict(task_env, BRENDA_TASK_PHASE='prepare'))
+
+        local.prepared.append(task)
+        return task
+
+    def poll_prepared(reasserts):
+        for task in list(local.prepared):
+            if task.proc is not None:
+                task.retcode = task.proc.poll()
+                if task.retcode is not None:
+                    task.proc = None
+                    if task.retcode != 0:
+                        local.prepared.remove(task)
+                        task_failed(task, 'prepare', "Prepare phase of render task \"{} #{}\" exited with status code {}".format(
+                            task.script_name, task.id, task.retcode))
+                        continue
+                    task.metrics['prepare'] = round(time.time() - task.prepare_start, 3)
+                    logging.info('Prepared render task \"%s #%d\"', task.script_name, task.id)
+            if reasserts is not None:
+                reasserts.append(task.msg)
+
+    def start_render_task(q, slot):
+        # Get the first prepared task that is ready to render
+        ready = [task for task in local.prepared if task.proc is None]
+        if not ready:
+            return None
+        task = ready[0]
+        local.prepared.remove(task)
+        task.retcode = None
+
+        # register render task
+        slot.task_render = task
+
+        # run the script
+        with utils.Cd(task.outdir):
+            task.start_time = time.time()
+            task.proc = Subprocess(["./{}".format(task.script_name)], env=dict(task_env, BRENDA_TASK_PHASE='render'))
+
+        # upload frames while the render is still running
+        if stream_upload:
+            task.stream_done = multiprocessing.Event()
+            task.stream = start_upload_process(opts, args, conf, task, task.stream_done)
+
+        logging.info('Running render task \"%s #%d\" in slot %d', task.script_name, task.id, slot.id)
+        logging.info(task.msg.get_body().replace("\n"," "))
+        logging.debug(task.__dict__)
+        return task
+
+    def receive_messages(q, wait_time):
+        # Fill the prefetch buffer with enough messages to occupy every free
+        # render slot plus PREFETCH_DEPTH (or PREPARE_AHEAD) spare ones, using
+        # a single long-poll receive of up to 10 messages.  Prepared tasks
+        # count as held messages.
+        free = len([slot for slot in local.slots if slot.task_render is None])
+        held = len(local.prefetch) + len(local.prepared)
+        want = min(free + max(prefetch_depth, prepare_ahead) - held, 10)
+        if want <= 0:
+            return None
+        logging.debug('Reading up to %d messages from work queue (wait %ds)', want, wait_time)
+        t = time.time()
+        msgs = breaker.call(q.receive, want, visibility_timeout, wait_time)
+        now = time.time()
+        for msg in msgs:
+            msg.received = now
+            msg.receive_latency = now - t
+        # higher priorities run first
+        local.prefetch.extend(msgs)
+        local.prefetch.sort(key=lambda msg: -msg.level.priority)
+        return len(msgs)
+
+    def poll_slot(q, slot, reasserts):
+        for i, task in enumerate((slot.task_render, slot.task_upload)):
+            if task:
+                name = task_names[i]
+                if task.proc is not None:
+                    # test if process has finished
+                    task.retcode = task.proc.poll()
+                    if task.retcode is not None:
+                        # process has finished
+                        if name == 'render':
+                            render_finished(task, task.proc)
+                        task.proc = None
+
+                        # did process finish with errors?
+                        if task.retcode != 0:
+                            if name == 'render':
+                                render_failed(slot, task)
+                            else:
+                                upload_failed(slot, task)
+                            continue
+
+                        # Process finished successfully.  If upload process,
+                        # tell SQS that the task completed successfully (batched
+                        # with other completed tasks, see flush_deletes).
+                        if name == 'upload':
+                            logging.info('Finished upload task #%d', task.id)
+                            upload_finished(task)
+                            local.pending_delete.append(task.msg)
+                            task.msg = None
+                            local.task_count += 1
+                            task_complete_accounting(local.task_count)
+                            local.task_failures = 0
+
+                        # Render task completed?
+                        if name == 'render':
+                            logging.info('Finished render task \"%s #%d\"', task.script_name, task.id)
+
+                # tell SQS that we are still working on the task
+                if reasserts is not None and task.proc is not None:
+                    logging.debug('Reasserting %s task %d with SQS', name, task.id)
+                    reasserts.append(task.msg)
+
+        # once both the render and the previous upload are finished, clean up the
+        # upload task and start a concurrent upload task to commit files generated
+        # by the just-completed render task to S3
+        # (when streaming, the task's streaming upload process becomes the upload task)
+        render_task, upload_task = slot.task_render, slot.task_upload
+        if (render_task and render_task.proc is None) and (not upload_task or upload_task.proc is None):
+            cleanup(upload_task, 'upload')
+            if render_task.stream is not None:
+                render_task.stream_done.set()
+                render_task.proc = render_task.stream
+                render_task.stream = None
+            else:
+                render_task.proc = start_upload_process(opts, args, conf, render_task)
+            slot.task_upload = render_task
+            slot.task_render = None
+        elif not render_task and upload_task and upload_task.proc is None:
+            cleanup(upload_task, 'upload')
+            slot.task_upload = None
+
     def task_loop():
         try:
             # reset tasks
-            local.task_render = None
-            local.task_upload = None
+            for slot in local.slots:
+                slot.task_render = None
+                slot.task_upload = None
 
-            # get SQS work queue
-            q = aws.get_sqs_conn_queue(conf)[0]
+            # get the work queues of all priority levels (SQS or another work queue backend)
+            q = local.q = workqueue.FairQueue(conf, queue_empty_backoff)
 
-            # Loop over tasks.  There are up to two different tasks at any
-            # given moment that we are processing concurrently:
+            # Loop over tasks.  Each render slot has up to two different tasks at
+            # any given moment that we are processing concurrently:
             #
             # 1. Render task -- usually a render operation.
             # 2. Upload task -- a task which uploads results to S3.
+            #
+            # While processing, we periodically reassert with SQS to acknowledge
+            # that tasks are still pending. (If we don't reassert with SQS frequently
+            # enough, it will assume we died, and put our tasks back in the queue.
+            # "frequently enough" means within visibility_timeout.)
+            last_reassert = time.time()
+            next_read = 0
             while True:
-                # reset render task
-                local.task_render = None
-
-                # initialize render task object
-                task = State()
-                task.msg = None
-                task.proc = None
-                task.retcode = None
-                task.outdir = None
-                task.id = 0
-                task.script_name = None
-
-                # Get a task from the SQS work queue.  This is normally
-                # a short script that renders one or more frames.
-                task.msg = q.read(message_attributes=['All'])
-
-                # output some debug info
-                logging.debug('Reading work queue')
-                if local.task_upload:
-                    logging.info("Running upload task #%d", local.task_upload.id)
-                    logging.debug(local.task_upload.__dict__)
-                else:
-                    logging.info('No upload task available')
-
-                # process task
-                if task.msg is not None:
-                    # assign an ID to task
-                    local.task_id_counter += 1
-                    task.id = local.task_id_counter
-                    task.script_name = task.msg.message_attributes['script_name']['string_value']
-
-                    # register render task
-                    local.task_render = task
-
-                    # create output directory
-                    task.outdir = os.path.join(work_dir, "{}_out_{}".format(task.script_name, task.id))
-                    utils.rmtree(task.outdir)
-                    utils.mkdir(task.outdir)
-
-                    # get the task script
-                    script = task.msg.get_body()
-
-                    # cd to output directory, where we will run render task from
-                    with utils.Cd(task.outdir):
-                        # write script file and make it executable
-                        script_fn = "./{}".format(task.script_name)
-                        with open(script_fn, 'w') as f:
-                            f.write(script)
-                        st = os.stat(script_fn)
-                        os.chmod(script_fn, st.st_mode | (stat.S_IEXEC|stat.S_IXGRP|stat.S_IXOTH))
-
-                        # run the script
-                        task.proc = Subprocess([script_fn])
-
-                    logging.info('Running render task \"%s #%d\"', local.task_render.script_name, local.task_render.id)
-                    logging.info(script.replace("\n"," "))
-                    logging.debug(local.task_render.__dict__)
-
-                # Wait for render & upload tasks to complete, while periodically reasserting with SQS to
-                # acknowledge that tasks are still pending. (If we don't reassert with SQS frequently enough,
-                # it will assume we died, and put our tasks back in the queue.  "frequently enough" means within
-                # visibility_timeout.)
-                count = 0
-                while True:
-                    reassert = (count >= visibility_timeout_reassert)
-                    for i, task in enumerate((local.task_render, local.task_upload)):
-                        if task:
-                            name = task_names[i]
-                            if task.proc is not None:
-                                # test if process has finished
-                                task.retcode = task.proc.poll()
-                                if task.retcode is not None:
-                                    # process has finished
-                                    task.proc = None
-
-                                    # did process finish with errors?
-                                    if task.retcode != 0:
-                                        if name == 'render':
-                                            errtxt = "Render task \"{} #{}\" exited with status code {}".format(
-                                            task.script_name, task.id, task.retcode)
-                                            raise error.ValueErrorRetry(errtxt)
-                                        else:
-                                            errtxt = "Upload task #{} exited with status code {}".format(
-                                            task.id, task.retcode)
-                                            raise ValueError(errtxt)
-
-                                    # Process finished successfully.  If upload process,
-                                    # tell SQS that the task completed successfully.
-                                    if name == 'upload':
-                                        logging.info('Finished upload task #%d', task.id)
-                                        q.delete_message(task.msg)
-                                        task.msg = None
-                                        local.task_count += 1
-                                        task_complete_accounting(local.task_count)
- 
-                                    # Render task completed?
-                                    if name == 'render':
-                                        logging.info('Finished render task \"%s #%d\"', task.script_name, task.id)
-
-                            # tell SQS that we are still working on the task
-                            if reassert and task.proc is not None:
-                                logging.debug('Reasserting %s task %d with SQS', name, task.id)
-                                task.msg.change_visibility(visibility_timeout)
-
-                    # break out of loop only when no pending tasks remain
-                    if ((not local.task_render or local.task_render.proc is None)
-                        and (not local.task_upload or local.task_upload.proc is None)):
+                reasserts = None
+                if time.time() - last_reassert >= visibility_timeout_reassert:
+                    last_reassert = time.time()
+                    reasserts = []
+                for slot in local.slots:
+                    poll_slot(q, slot, reasserts)
+                poll_prepared(reasserts)
+
+                # After a spot interruption notice, hand back all unfinished
+                # work, let the uploads of finished renders complete until
+                # shortly before the deadline, then exit.
+                if local.spot_watcher and local.spot_watcher.noticed.is_set():
+                    if not local.interrupted:
+                        local.interrupted = True
+                        hand_back_tasks()
+                    flush_deletes()
+                    uploading = [slot for slot in local.slots if slot.task_upload or slot.task_render]
+                    if not uploading:
+                        logging.info('Exiting on spot interruption')
                         break
-
-                    # setup for next process poll iteration
-                    if reassert:
-                        count = 0
+                    if time.time() >= local.spot_watcher.deadline - spot_notice_margin:
+                        logging.warning('Exiting on spot interruption with %d uploads unfinished', len(uploading))
+                        break
+                    if reasserts is not None:
+                        flush_reasserts(reasserts)
                     time.sleep(1)
-                    count += 1
-
-                # clean up the upload task
-                cleanup(local.task_upload, 'upload')
-                local.task_upload = None
-
-                # start a concurrent upload task to commit files generated by just-completed render task to S3
-                if local.task_render:
-                    local.task_render.proc = start_upload_process(opts, args, conf, local.task_render)
-                    local.task_upload = local.task_render
-                    local.task_render = None
-
-                # if no render or upload task, we are done (unless DONE is set to "poll")
-                if not local.task_render and not local.task_upload:
-                    if read_done_file() == "poll":
-                        logging.info('Waiting for tasks...')
-                        time.sleep(15)
-                    else:
-                        logging.info('Exiting')
+                    continue
+
+                # Completed tasks are deleted and pending tasks (including
+                # prefetched messages) are reasserted in batches of up to 10.
+                # Deletes are held back until a batch is full or it is time to
+                # reassert, which is well within visibility_timeout.
+                if reasserts is not None or len(local.pending_delete) >= aws.SQS_BATCH_SIZE:
+                    flush_deletes()
+                if reasserts is not None:
+                    flush_reasserts(reasserts + local.prefetch)
+
+                # Set up tasks from the prefetch buffer for the free render slots
+                # plus PREPARE_AHEAD more, so that the next task is ready (and
+                # its prepare phase done) the moment a slot frees up.
+                free = len([slot for slot in local.slots if slot.task_render is None])
+                while local.prefetch and len(local.prepared) < free + prepare_ahead:
+                    prepare_task()
+
+                # fill free render slots with prepared tasks
+                for slot in local.slots:
+                    if slot.task_render is None and start_render_task(q, slot) is None:
                         break
 
+                busy = [slot for slot in local.slots if slot.task_render or slot.task_upload] or local.prepared
+                if not busy:
+                    flush_deletes()
+                    # Nothing to watch, so block in a long poll until work arrives.
+                    if not local.prefetch and not receive_messages(q, receive_wait_time):
+                        # if no render or upload task, we are done (unless DONE is set to "poll")
+                        if read_done_file() == "poll":
+                            logging.info('Waiting for tasks...')
+                        else:
+                            logging.info('Exiting')
+                            break
+                    continue
+
+                # While tasks are running, the receive wait time doubles as the
+                # process poll interval.  While a render slot is free, keep
+                # polling so that a new task starts within a second; once every
+                # slot is busy, back off after an empty receive so a drained
+                # queue isn't hammered for the prefetch buffer alone.
+                slots_busy = all(slot.task_render for slot in local.slots)
+                if not slots_busy or time.time() >= next_read:
+                    n = receive_messages(q, 1)
+                    if n:
+                        continue
+                    if n is not None:
+                        if slots_busy:
+                            next_read = time.time() + receive_wait_time
+                        continue
+                time.sleep(1)
+
         finally:
             cleanup_all()
 
-    # initialize task_render and task_upload states
+    # get configuration parameters
+    work_dir = utils.get_work_dir(conf)
+    manifest_dir = os.path.join(work_dir, upload.MANIFESTS_DIR)
+    visibility_timeout_reassert = int(conf.get('VISIBILITY_TIMEOUT_REASSERT', '30'))
+    visibility_timeout = int(conf.get('VISIBILITY_TIMEOUT', '120'))
+    render_slots = get_render_slots(conf)
+    stream_upload = int(conf.get('STREAM_UPLOAD', '0'))
+    receive_wait_time = min(int(conf.get('RECEIVE_WAIT_TIME', '20')), 20)
+    prefetch_depth = int(conf.get('PREFETCH_DEPTH', '0'))
+    prepare_ahead = int(conf.get('PREPARE_AHEAD', '0'))
+    spot_notice_margin = int(conf.get('SPOT_NOTICE_MARGIN', '10'))
+    queue_empty_backoff = float(conf.get('QUEUE_EMPTY_BACKOFF', '5'))
+    max_task_failures = max(int(conf.get('ERROR_RETRIES', '5')), 1)
+
+    # task scripts declare a prepare phase with a "# brenda: prepare" line
+    re_prepare = re.compile(r'^#\s*brenda:\s*prepare\s*$', re.MULTILINE)
+
+    # pass the configuration on to task scripts, for brenda-asset
+    task_env = dict(os.environ)
+    task_env.update([('BRENDA_' + k, v) for k, v in conf.iteritems()])
+    # resolved here, as task scripts run in their own task dir
+    task_env['BRENDA_WORK_DIR'] = work_dir
+    task_env['BRENDA_ASSET_CACHE_DIR'] = cache.get_cache_dir(conf)
+
+    # initialize render slots with their task_render and task_upload states
     task_names = ('render', 'upload')
     local = State()
-    local.task_render = None
-    local.task_upload = None
+    local.slots = []
+    for i in xrange(render_slots):
+        slot = State()
+        slot.id = i
+        slot.task_render = None
+        slot.task_upload = None
+        local.slots.append(slot)
+    local.q = None
+    local.prefetch = []
+    local.prepared = []
+    local.pending_delete = []
     local.task_id_counter = 0
     local.task_count = 0
+    local.task_failures = 0
+    local.task_last = None
+    local.spot_watcher = None
+    local.interrupted = False
+    recorder = metrics.TaskRecorder(conf, work_dir)
+
+    # Every work queue request counts towards the circuit breaker of the
+    # queue, so that a single success closes it again.
+    breaker = error.get_breaker(conf, 'queue')
+    logging.info('Using %d render slot(s)', render_slots)
+
+    # serve metrics over HTTP, if enabled
+    metrics_port = int(conf.get('METRICS_PORT', '0'))
+    if metrics_port:
+        def slot_states():
+            return [({'state': 'rendering'}, len([s for s in local.slots if s.task_render])),
+                    ({'state': 'uploading'}, len([s for s in local.slots if s.task_upload])),
+                    ({'state': 'idle'}, len([s for s in local.slots if not s.task_render and not s.task_upload]))]
+        metrics.REGISTRY.add(metrics.Callback('brenda_render_slots', 'Number of render slots by state', 'gauge', slot_states))
+        metrics.REGISTRY.add(metrics.Callback('brenda_prefetched_messages', 'Number of messages in the prefetch buffer', 'gauge',
+                                              lambda: len(local.prefetch)))
+        metrics.REGISTRY.add(metrics.Callback('brenda_prepared_tasks', 'Number of tasks set up ahead of a free render slot', 'gauge',
+                                              lambda: len(local.prepared)))
+        metrics.REGISTRY.add(metrics.Callback('brenda_pending_delete_messages', 'Number of completed tasks waiting to be deleted from the queue', 'gauge',
+                                              lambda: len(local.pending_delete)))
+        server = metrics.MetricsServer((conf.get('METRICS_ADDRESS', ''), metrics_port), metrics.MetricsHandler)
+        server.start()
 
     # setup signal handler
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    # get configuration parameters
-    work_dir = utils.get_work_dir(conf)
-    visibility_timeout_reassert = int(conf.get('VISIBILITY_TIMEOUT_REASSERT', '30'))
-    visibility_timeout = int(conf.get('VISIBILITY_TIMEOUT', '120'))
-
     # validate OUTPUT_URL
-    aws.get_s3_output_bucket(conf)
+    upload.validate_output(conf)
 
     # file cleanup
     utils.rm(os.path.join(work_dir, 'task_count'))
     utils.rm(os.path.join(work_dir, 'task_last'))
+    if os.path.isdir(manifest_dir):
+        upload.remove_stale_manifests(manifest_dir)
+    else:
+        utils.makedirs(manifest_dir)
 
     # save the value of DONE config var
     write_done_file()
 
     # Get our spot instance request, if it exists
     spot_request_id = None
+    instance_id = None
     if int(conf.get('RUNNING_ON_EC2', '1')):
         try:
             instance_id = aws.get_instance_id_self()
@@ -313,13 +739,43 @@ def run_tasks(opts, args, conf):
         except Exception:
             logging.exception('Failed getting spot instance request')
 
+    # share the asset cache with the other nodes, if enabled
+    peer_port = peers.get_port(conf)
+    if peer_port:
+        ac = cache.AssetCache(conf, use_peers=False)
+        refresher = None
+        if not conf.get('ASSET_PEERS_FILE'):
+            refresher = peers.Refresher(conf, ac.dir, instance_id)
+            refresher.start()
+        peers.AssetServer(('', peer_port), ac, refresher).start()
+
     # continue only if we are not in "dry-run" mode
     if not opts.dry_run:
+        # watch for spot interruption notices on spot instances, or wherever
+        # SPOT_NOTICE_URL is set
+        if spot_request_id or conf.get('SPOT_NOTICE_URL'):
+            local.spot_watcher = spot.NoticeWatcher(conf.get('SPOT_NOTICE_URL', spot.NOTICE_URL),
+                                                    float(conf.get('SPOT_NOTICE_INTERVAL', '5')))
+            local.spot_watcher.start()
+
+        # publish heartbeats for brenda-tool, if enabled
+        publisher = None
+        store = heartbeat.get_store(conf)
+        if store is not None:
+            publisher = heartbeat.Publisher(conf, store, heartbeat.get_node_id(instance_id), heartbeat_state)
+            publisher.start()
+
         # execute the task loop
-        error.retry(conf, task_loop)
+        try:
+            error.retry(conf, task_loop)
+        finally:
+            if publisher:
+                publisher.stop()
 
-        # if "DONE" file == "shutdown", do a shutdown now as we exit
-        if read_done_file() == "shutdown":
+        # if "DONE" file == "shutdown", do a shutdown now as we exit (unless
+        # EC2 is taking the instance away, and may relaunch a persistent
+        # spot request later)
+        if read_done_file() == "shutdown" and not local.interrupted:
             if spot_request_id:
                 try:
                     # persistent spot instances must be explicitly cancelled, or
@@ -331,6 +787,7 @@ def run_tasks(opts, args, conf):
             utils.shutdown()
 
         logging.info('Completed %d tasks', local.task_count)
+        logging.info('SQS requests: %s', aws.format_sqs_requests())
 
 def validate_done(d):
     done_choices = ('exit', 'shutdown', 'poll')
@@ -348,3 +805,15 @@ def get_done(opts, conf):
         else:
             sd = int(conf.get('SHUTDOWN', '0'))
             return 'shutdown' if sd else 'exit'
+
+def get_render_slots(conf):
+    slots = conf.get('RENDER_SLOTS', '1')
+    if slots == 'auto':
+        return multiprocessing.cpu_count()
+    try:
+        slots = int(slots)
+    except ValueError:
+        slots = 0
+    if slots < 1:
+        raise ValueError("RENDER_SLOTS config var must be 'auto' or a number >= 1")
+    return slots
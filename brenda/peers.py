@@ -0,0 +1,282 @@
+# Brenda -- Render farm tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Peer-to-peer sharing of asset caches.  With ASSET_PEER_PORT set,
+# brenda-node serves the objects of its asset cache to the other nodes of
+# the farm over HTTP, and the asset cache fetches objects from a peer
+# before falling back to S3.
+#
+# Every object is owned by one of the peers, chosen by rendezvous hashing
+# of its ETag over the peer addresses.  A node asks the owner for the
+# object; the owner fetches it from S3 into its own cache on the first
+# request and serves it to the others from there, so a cold start of the
+# whole fleet reads each object from S3 about once.  If the owner fails,
+# the next peer in the ranking takes its place, and a node that owns the
+# object itself goes to S3.
+#
+# The peers are the running instances tagged with ASSET_PEER_TAGS, looked
+# up by brenda-node and saved in ASSET_CACHE_DIR/peers for brenda-asset,
+# or the hosts listed in the ASSET_PEERS_FILE hosts file.
+
+import os, re, time, json, socket, shutil, hashlib, httplib, urllib, urlparse
+import threading, logging, BaseHTTPServer, SocketServer
+from brenda import aws, download, utils
+
+PEERS_NAME = 'peers'
+
+def get_port(conf):
+    return int(conf.get('ASSET_PEER_PORT', '0'))
+
+def parse_tags(tags):
+    # "KEY=VALUE,KEY=VALUE" to a list of (key, value)
+    ret = []
+    for tag in tags.split(','):
+        if tag.strip():
+            key, value = tag.split('=', 1)
+            ret.append((key.strip(), value.strip()))
+    return ret
+
+class InstanceFilter(object):
+    # the options of aws.filter_instances for the instances of the farm
+    def __init__(self, conf):
+        self.tags = parse_tags(conf.get('ASSET_PEER_TAGS', 'Stack=brenda-render'))
+        self.imatch = None
+        self.threshold = 0
+
+def read_hosts_file(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+def local_addresses():
+    hostname = socket.gethostname()
+    addrs = set([hostname, socket.getfqdn()])
+    try:
+        addrs.update(socket.gethostbyname_ex(hostname)[2])
+    except socket.error:
+        pass
+    return addrs
+
+def discover(conf, instance_id=None):
+    """
+    Return (self, peers), the address of this node and the addresses of
+    all nodes of the farm (including this one).
+    """
+    hosts_file = conf.get('ASSET_PEERS_FILE')
+    if hosts_file:
+        peers = read_hosts_file(hosts_file)
+        me = conf.get('ASSET_PEER_ADDRESS')
+        if not me:
+            local = local_addresses()
+            me = next((p for p in peers if p in local), None)
+        return me, peers
+    instances = aws.filter_instances(InstanceFilter(conf), conf, {'instance-state-name': 'running'})
+    peers = [i.private_ip_address for i in instances if i.private_ip_address]
+    me = conf.get('ASSET_PEER_ADDRESS')
+    if not me:
+        me = next((i.private_ip_address for i in instances if i.id == instance_id), None)
+    return me, peers
+
+def save(cache_dir, me, peers):
+    utils.write_atomic(os.path.join(cache_dir, PEERS_NAME), json.dumps(dict(self=me, peers=peers), sort_keys=True))
+
+def load(conf, cache_dir):
+    # the peers of a node, from ASSET_PEERS_FILE or as saved by brenda-node
+    if conf.get('ASSET_PEERS_FILE'):
+        return discover(conf)
+    try:
+        with open(os.path.join(cache_dir, PEERS_NAME)) as f:
+            d = json.load(f)
+        return d['self'], d['peers']
+    except (IOError, ValueError, KeyError):
+        return None, []
+
+def rank(etag, peers):
+    # rendezvous hashing: every node agrees on the order without coordination
+    return sorted(peers, key=lambda p: hashlib.md5(etag + '/' + p).digest(), reverse=True)
+
+class Refresher(object):
+    """
+    Refresher looks up the peers of the node every ASSET_PEER_REFRESH
+    seconds from a daemon thread and saves them for brenda-asset.
+    """
+
+    def __init__(self, conf, cache_dir, instance_id):
+        self.conf = conf
+        self.cache_dir = cache_dir
+        self.instance_id = instance_id
+        self.interval = int(conf.get('ASSET_PEER_REFRESH', '300'))
+        self.peers = set()
+
+    def refresh(self):
+        try:
+            me, peers = discover(self.conf, self.instance_id)
+            save(self.cache_dir, me, peers)
+            self.peers = set(peers)
+            logging.debug('Found %d asset peers', len(peers))
+        except Exception, e:
+            logging.warning('Failed looking up asset peers: %s', e)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.refresh()
+
+    def start(self):
+        self.refresh()
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+class AssetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET /objects/ETAG?url=URL returns a cached object.  An object that
+    isn't cached yet is fetched from URL first, if it still has that
+    ETag.
+    """
+
+    def do_GET(self):
+        if not self.server.allowed(self.client_address[0]):
+            self.send_error(403)
+            return
+        u = urlparse.urlparse(self.path)
+        parts = u.path.split('/')
+        if len(parts) != 3 or parts[1] != 'objects' or not re.match(r'^[0-9a-f]{32}(-\d+)?$', parts[2]):
+            self.send_error(404)
+            return
+        etag = parts[2]
+        url = urlparse.parse_qs(u.query).get('url', [None])[0]
+        ac = self.server.cache
+        path = ac.object_path(etag)
+        try:
+            # an object evicted while it is sent stays readable
+            f = open(path, 'rb')
+        except IOError:
+            f = None
+            if url:
+                try:
+                    path = ac.fetch(url)
+                except Exception, e:
+                    logging.warning('Failed fetching asset %s for peer %s: %s', url, self.client_address[0], e)
+                    self.send_error(502)
+                    return
+                if os.path.basename(path) == etag:
+                    f = open(path, 'rb')
+        if f is None:
+            self.send_error(404)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            self.wfile.flush()
+            if not utils.kernel_copy(f.fileno(), self.connection.fileno(), size):
+                shutil.copyfileobj(f, self.wfile, 1024*1024)
+        logging.info('Served asset %s (%d bytes) to peer %s', etag, size, self.client_address[0])
+
+    def log_message(self, format, *args):
+        logging.debug('Asset request from %s: %s', self.client_address[0], format % args)
+
+class AssetServer(SocketServer.ThreadingMixIn, utils.HTTPServer):
+    """
+    AssetServer serves the asset cache ac to the peers of the node, one
+    thread per request so that a slow fetch doesn't hold up the others.
+    """
+
+    daemon_threads = True
+
+    # seconds for which the resolved addresses of the peers are reused
+    PEER_TTL = 60
+
+    def __init__(self, address, ac, refresher=None):
+        utils.HTTPServer.__init__(self, address, AssetHandler)
+        self.cache = ac
+        self.refresher = refresher
+        self.peer_addrs = (0, set())
+        self.lock = threading.Lock()
+
+    def allowed(self, addr):
+        # only the nodes of the farm may make this node fetch from S3
+        if addr.startswith('127.'):
+            return True
+        with self.lock:
+            t, addrs = self.peer_addrs
+            if time.time() - t > self.PEER_TTL:
+                if self.refresher is not None:
+                    names = self.refresher.peers
+                else:
+                    names = load(self.cache.conf, self.cache.dir)[1]
+                addrs = set()
+                for name in names:
+                    try:
+                        addrs.add(socket.gethostbyname(name))
+                    except socket.error:
+                        continue
+                self.peer_addrs = (time.time(), addrs)
+        return addr in addrs
+
+    def start(self):
+        utils.HTTPServer.start(self)
+        logging.info('Serving asset cache to peers on port %d', self.server_address[1])
+
+def get_from_peer(conf, peer, url, etag, size, path):
+    # download an object from a peer to path and verify it
+    port = get_port(conf)
+    conn = httplib.HTTPConnection(peer, port, timeout=int(conf.get('ASSET_PEER_TIMEOUT', '5')))
+    try:
+        conn.connect()
+        # the owner may have to fetch the object from S3 before it answers
+        conn.sock.settimeout(int(conf.get('ASSET_PEER_WAIT', '3600')))
+        conn.request('GET', '/objects/%s?%s' % (etag, urllib.urlencode(dict(url=url))))
+        resp = conn.getresponse()
+        if resp.status != 200:
+            raise ValueError("HTTP %d %s" % (resp.status, resp.reason))
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(resp, f, 1024*1024)
+    finally:
+        conn.close()
+    if os.path.getsize(path) != size:
+        raise ValueError("size does not match")
+    if download.verify_etag(path, etag) is False:
+        raise ValueError("checksum does not match ETag %s" % (etag,))
+
+def fetch(conf, cache_dir, url, etag, size, path):
+    """
+    Try to download the object of url with etag from the peers that rank
+    above this node for it.  Return False if this node should fetch the
+    object from S3 itself.
+    """
+    me, peers = load(conf, cache_dir)
+    if not peers:
+        return False
+    tries = int(conf.get('ASSET_PEER_TRIES', '3'))
+    for peer in rank(etag, set(peers) | set([me] if me else [])):
+        if peer == me or tries <= 0:
+            return False
+        tries -= 1
+        t = time.time()
+        try:
+            get_from_peer(conf, peer, url, etag, size, path)
+        except Exception, e:
+            logging.warning('Failed fetching %s from peer %s: %s', url, peer, e)
+            utils.rm(path)
+            continue
+        elapsed = time.time() - t
+        logging.info('Fetched %s from peer %s in %.1fs (%.1f MB/s)', url, peer, elapsed,
+                     float(size) / download.MB / max(elapsed, 0.001))
+        return True
+    return False
@@ -170,9 +170,53 @@ def startup_script(opts, conf):
         "LOG_DAEMON",
         "VISIBILITY_TIMEOUT",
         "VISIBILITY_TIMEOUT_REASSERT",
+        "RENDER_SLOTS",
+        "RECEIVE_WAIT_TIME",
+        "WORK_QUEUES",
+        "WORK_QUEUE_WEIGHT",
+        "QUEUE_EMPTY_BACKOFF",
+        "PREFETCH_DEPTH",
+        "PREPARE_AHEAD",
+        "UPLOAD_THREADS",
+        "UPLOAD_PART_SIZE",
+        "UPLOAD_RETRIES",
+        "UPLOAD_RETRY_PAUSE",
+        "STREAM_UPLOAD",
+        "STREAM_UPLOAD_STABLE",
+        "STREAM_UPLOAD_DELETE",
+        "TASK_METRICS_SIZE",
+        "TASK_METRICS_BACKUPS",
+        "TASK_METRICS_WINDOW",
+        "METRICS_PORT",
+        "METRICS_ADDRESS",
+        "HEARTBEAT_URL",
+        "HEARTBEAT_INTERVAL",
+        "ASSET_CACHE_DIR",
+        "ASSET_CACHE_SIZE",
+        "ASSET_PEER_PORT",
+        "ASSET_PEER_TAGS",
+        "ASSET_PEERS_FILE",
+        "ASSET_PEER_ADDRESS",
+        "ASSET_PEER_REFRESH",
+        "ASSET_PEER_TIMEOUT",
+        "ASSET_PEER_WAIT",
+        "ASSET_PEER_TRIES",
+        "DOWNLOAD_THREADS",
+        "DOWNLOAD_PART_SIZE",
+        "DOWNLOAD_RETRIES",
+        "DOWNLOAD_RETRY_PAUSE",
+        "SPOT_NOTICE_URL",
+        "SPOT_NOTICE_INTERVAL",
+        "SPOT_NOTICE_MARGIN",
         "ERROR_RETRIES",
         "ERROR_PAUSE",
         "ERROR_RESET",
+        "RETRY_THROTTLE",
+        "RETRY_CONNECTION",
+        "RETRY_SERVER",
+        "RETRY_ERROR",
+        "CIRCUIT_THRESHOLD",
+        "CIRCUIT_RESET",
         "SHUTDOWN",
         "DONE"
         ]
@@ -0,0 +1,189 @@
+# Brenda -- Render farm tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Adaptive task sizing.  Render nodes record the frame range of every
+# render task along with its render time in their task metrics (see
+# metrics).  From those records (or from sample renders run by brenda-work
+# push), a cost model estimates the per-task overhead and the render time
+# of every frame, and the frame range is split into tasks that each take
+# about a target time.
+
+import os, time, json, tempfile, logging
+from brenda import utils
+
+# Fraction of the total render time over which tasks shrink towards
+# single frames at the end of the sequence, to tighten the makespan
+TAIL_FRACTION = 0.1
+
+def task_attributes(conf, start, end, step, subframes):
+    # message attributes that let nodes relate render times to frames
+    attr = {}
+    for name, value in (
+        ('job_name', conf.get('JOB_NAME', 'NONE')),
+        ('start', str(start)),
+        ('end', str(end)),
+        ('step', str(step)),
+        ('subframes', str(subframes)),
+        ):
+        attr[name] = {"data_type": "String", "string_value": value}
+    return attr
+
+def frame_attributes(msg):
+    """
+    Return the job and frame range of a task message for its task
+    metrics record, or an empty dict if the message was pushed without
+    frame attributes.
+    """
+    attr = msg.message_attributes
+    try:
+        return dict(
+            job=attr['job_name']['string_value'],
+            start=int(attr['start']['string_value']),
+            end=int(attr['end']['string_value']),
+            step=int(attr['step']['string_value']),
+            subframes=int(attr['subframes']['string_value']))
+    except (KeyError, ValueError):
+        return {}
+
+def read_history(paths, job_name=None):
+    # records of successful renders with a frame range from task metrics files
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    logging.warning('Ignoring malformed task metrics record in %s: %r', path, line)
+                    continue
+                if rec.get('exit') != 0 or 'start' not in rec or 'render' not in rec:
+                    continue
+                if job_name is None or rec.get('job') == job_name:
+                    records.append(rec)
+    return records
+
+def frame_equivalents(rec):
+    # number of whole frames rendered by the task of a record
+    frames = len(xrange(rec['start'], rec['end']+1, rec['step']))
+    return float(frames) / max(rec.get('subframes', 1), 1)
+
+class CostModel(object):
+    """
+    CostModel fits task durations as a fixed per-task overhead (script
+    start-up, downloads, scene load) plus the render time of each frame,
+    which is interpolated between the frames covered by the records.
+    """
+
+    def __init__(self, records):
+        if not records:
+            raise ValueError("no task timing records to estimate render times from")
+        samples = [(frame_equivalents(rec), float(rec['render'])) for rec in records]
+
+        # least squares fit of duration = overhead + n * frame time,
+        # only meaningful if tasks of different sizes were seen
+        n_mean = sum(n for n, d in samples) / len(samples)
+        d_mean = sum(d for n, d in samples) / len(samples)
+        var = sum((n - n_mean) ** 2 for n, d in samples)
+        overhead = 0.0
+        if var > 0:
+            slope = sum((n - n_mean) * (d - d_mean) for n, d in samples) / var
+            overhead = d_mean - slope * n_mean
+        self.overhead = min(max(overhead, 0.0), min(d for n, d in samples))
+
+        # render time per frame, keyed by the middle frame of each record
+        points = {}
+        for rec, (n, d) in zip(records, samples):
+            mid = (rec['start'] + rec['end']) / 2.0
+            points.setdefault(mid, []).append(max(d - self.overhead, 0.0) / n)
+        self.points = sorted((mid, sum(v) / len(v)) for mid, v in points.iteritems())
+
+    def frame_time(self, frame):
+        points = self.points
+        if frame <= points[0][0]:
+            return points[0][1]
+        for (f0, t0), (f1, t1) in zip(points, points[1:]):
+            if frame <= f1:
+                return t0 + (t1 - t0) * (frame - f0) / (f1 - f0)
+        return points[-1][1]
+
+def plan_chunks(opts, model, target, subframes, tail=TAIL_FRACTION):
+    """
+    Split the frames of opts into (start, end) ranges of consecutive
+    frames, so that each task (one per subframe of a range) is estimated
+    to render in about target seconds including the task overhead.
+    Ranges shrink over the last tail fraction of the total render time,
+    down to a single frame.
+    """
+    frames = range(opts.start, opts.end+1, opts.step)
+    costs = [model.frame_time(f) / subframes for f in frames]
+    budget = target - model.overhead
+    if budget <= 0:
+        logging.warning('Estimated task overhead of %.1fs exceeds target duration of %ds', model.overhead, target)
+
+    total = sum(costs)
+    remaining = total
+    chunks = []
+    i = 0
+    while i < len(frames):
+        goal = budget
+        if remaining < tail * total:
+            goal *= remaining / (tail * total)
+        acc = costs[i]
+        j = i + 1
+        while j < len(frames) and acc + costs[j] <= goal:
+            acc += costs[j]
+            j += 1
+        chunks.append((frames[i], min(frames[j-1] + opts.step - 1, opts.end)))
+        remaining -= acc
+        i = j
+    return chunks
+
+def sample_renders(opts, conf, template_fn, n_samples, subframes):
+    """
+    Render n_samples tasks spread over the frame range locally, in
+    scratch directories of the work dir like brenda-node does, and
+    return their timing records.  Tasks of one and two frames are
+    alternated so that the per-task overhead can be estimated.
+    template_fn(start, end) returns the script of the first task (and
+    subframe) of a range.
+    """
+    frames = range(opts.start, opts.end+1, opts.step)
+    n_samples = max(min(n_samples, len(frames)), 1)
+    work_dir = utils.get_work_dir(conf)
+    records = []
+    for i in xrange(n_samples):
+        idx = i * (len(frames) - 1) // max(n_samples - 1, 1)
+        size = 1 + i % 2
+        chunk = frames[idx:idx+size]
+        start, end = chunk[0], min(chunk[-1] + opts.step - 1, opts.end)
+        outdir = tempfile.mkdtemp(prefix='sample_', dir=work_dir)
+        try:
+            script_fn = os.path.join(outdir, 'task_script')
+            with open(script_fn, 'w') as f:
+                f.write(template_fn(start, end))
+            os.chmod(script_fn, 0755)
+            logging.info('Sampling render time of frames %d-%d', start, end)
+            t = time.time()
+            with utils.Cd(outdir):
+                utils.system([script_fn])
+            duration = time.time() - t
+        finally:
+            utils.rmtree(outdir)
+        logging.info('Frames %d-%d rendered in %.1fs', start, end, duration)
+        records.append(dict(start=start, end=end, step=opts.step,
+                            subframes=subframes,
+                            render=duration))
+    return records
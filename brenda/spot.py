@@ -0,0 +1,117 @@
+# Brenda -- Render farm tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Spot instance interruption notices.  About two minutes before EC2 stops
+# or terminates a spot instance, the instance metadata path
+# spot/instance-action starts returning a JSON notice such as
+#
+#   {"action": "terminate", "time": "2017-09-18T08:22:00Z"}
+#
+# and 404 until then.  The notice URL can be set with SPOT_NOTICE_URL, so
+# that a node can be tested against a local server.
+
+import time, json, calendar, urllib2, urlparse, threading, logging
+
+NOTICE_URL = 'http://169.254.169.254/latest/meta-data/spot/instance-action'
+
+# time left after a notice without a parseable time
+DEFAULT_WARNING = 120
+
+class NoticeWatcher(object):
+    """
+    NoticeWatcher polls the spot interruption notice every interval
+    seconds from a daemon thread.  Once a notice is posted, noticed is
+    set and deadline is the time of the interruption.
+    """
+
+    # timeout in seconds of a metadata request
+    timeout = 2
+
+    # number of seconds a session token is reused, within its TTL of 300
+    token_reuse = 240
+
+    def __init__(self, url, interval):
+        self.url = url
+        self.interval = interval
+        self.noticed = threading.Event()
+        self.notice = None
+        self.deadline = None
+        self.token = (0, None)
+
+    def get_token(self):
+        # IMDSv2 session token, or None where only IMDSv1 is available
+        t, token = self.token
+        if time.time() - t < self.token_reuse:
+            return token
+        token = self.request_token()
+        self.token = (time.time(), token)
+        return token
+
+    def request_token(self):
+        u = urlparse.urlparse(self.url)
+        req = urllib2.Request('%s://%s/latest/api/token' % (u.scheme, u.netloc),
+                              headers={'X-aws-ec2-metadata-token-ttl-seconds': '300'})
+        req.get_method = lambda: 'PUT'
+        try:
+            return urllib2.urlopen(req, timeout=self.timeout).read()
+        except Exception:
+            return None
+
+    def check(self):
+        """
+        Return the interruption notice, or None if there is none.
+        """
+        headers = {}
+        token = self.get_token()
+        if token:
+            headers['X-aws-ec2-metadata-token'] = token
+        try:
+            data = urllib2.urlopen(urllib2.Request(self.url, headers=headers), timeout=self.timeout).read()
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return None
+            raise
+        try:
+            return json.loads(data)
+        except ValueError:
+            return dict(action=data.strip())
+
+    def set_notice(self, notice):
+        self.notice = notice
+        try:
+            self.deadline = calendar.timegm(time.strptime(notice['time'], '%Y-%m-%dT%H:%M:%SZ'))
+        except (KeyError, TypeError, ValueError):
+            self.deadline = time.time() + DEFAULT_WARNING
+        logging.warning('Spot instance interruption notice: %s in %d seconds',
+                        notice.get('action', 'interruption'), self.deadline - time.time())
+        self.noticed.set()
+
+    def run(self):
+        while not self.noticed.is_set():
+            try:
+                notice = self.check()
+                if notice:
+                    self.set_notice(notice)
+                    return
+            except Exception, e:
+                logging.debug('Failed checking spot interruption notice: %s', e)
+            time.sleep(self.interval)
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+        logging.info('Watching for spot interruption notices at %s', self.url)
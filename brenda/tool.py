@@ -14,8 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, threading, time, Queue, logging
-from brenda import aws, utils
+import os, re, sys, errno, fcntl, select, socket, resource, subprocess, time, logging
+from brenda import aws, utils, heartbeat
 
 def instances(opts, conf):
     now = time.time()
@@ -36,9 +36,52 @@ def ssh_args(opts, conf):
         raise ValueError("No ssh private key exists, did you run 'brenda-run init'?")
 
     args.extend(['-i', ssh_local_fn])
+
+    # share one connection per host between ssh invocations
+    persist = get_control_persist(conf)
+    if persist > 0:
+        args.extend(['-o', 'ControlMaster=auto',
+                     '-o', 'ControlPath=' + os.path.join(get_control_dir(conf, mkdir=True), '%C'),
+                     '-o', 'ControlPersist=%d' % (persist,)])
     return args
 
+def get_control_persist(conf):
+    return int(conf.get('SSH_CONTROL_PERSIST', '600'))
+
+def get_control_dir(conf, mkdir=False):
+    control_dir = conf.get('SSH_CONTROL_DIR')
+    if not control_dir:
+        control_dir = os.path.join(os.path.expanduser("~"), '.ssh', 'brenda-control')
+    if mkdir and not os.path.isdir(control_dir):
+        os.makedirs(control_dir, 0700)
+    return control_dir
+
+def gc_control_sockets(conf):
+    """
+    Remove the control sockets of ssh masters that are gone, e.g. after
+    the host was terminated or the master was killed.  Live masters exit
+    by themselves after SSH_CONTROL_PERSIST seconds of idle time.
+    """
+    control_dir = get_control_dir(conf)
+    if get_control_persist(conf) <= 0 or not os.path.isdir(control_dir):
+        return
+    for fn in os.listdir(control_dir):
+        # skip the temporary sockets of masters that are starting up
+        if not re.match(r'^[0-9a-f]+$', fn):
+            continue
+        path = os.path.join(control_dir, fn)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+        except socket.error, e:
+            if e.errno == errno.ECONNREFUSED:
+                logging.debug('Removing stale ssh control socket %s', path)
+                utils.rm(path)
+        finally:
+            s.close()
+
 def ssh_cmd_list(opts, conf, args, instances=None):
+    gc_control_sockets(conf)
     if instances is None:
         instances = aws.filter_instances(opts, conf)
     for i in instances:
@@ -49,41 +92,182 @@ def ssh_cmd_list(opts, conf, args, instances=None):
         yield node, cmd
 
 def rsync_cmd_list(opts, conf, args):
+    gc_control_sockets(conf)
     for i in aws.filter_instances(opts, conf):
         node = i.public_dns_name
         cmd = ['rsync', '-e', ' '.join(ssh_args(opts, conf))] + [a.replace('HOST', node) for a in args]
         yield node, cmd
 
+class Command(object):
+    """
+    Command is a process started by run_cmd_list, with its stdout and
+    stderr merged into a single non-blocking pipe.
+    """
+
+    def __init__(self, node, cmd, devnull, timeout):
+        self.node = node
+        self.cmd = cmd
+        self.start = time.time()
+        self.deadline = self.start + timeout if timeout > 0 else None
+        self.killed_at = None
+        self.timed_out = False
+        # Inherited fds are only the read ends of the other commands'
+        # pipes, which can't hold them open, so skip the costly close_fds.
+        self.proc = subprocess.Popen(cmd, stdin=devnull, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+        self.fd = self.proc.stdout.fileno()
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.eof = False
+        self.exited_at = None
+        self.partial = ''
+        self.output = []
+        self.latency = None
+
+    def stop(self, now):
+        # cancel: SIGTERM first, SIGKILL if it is still around after a grace period
+        try:
+            if self.killed_at is None:
+                self.proc.terminate()
+                self.killed_at = now
+            elif now - self.killed_at >= KILL_GRACE:
+                self.proc.kill()
+        except OSError:
+            pass
+
+# seconds between SIGTERM and SIGKILL of a cancelled command
+KILL_GRACE = 5
+
+def get_concurrency(conf):
+    concurrency = int(conf.get('TOOL_CONCURRENCY', conf.get('TOOL_THREADS', '256')))
+    # every running command holds one pipe open in this process
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    return max(min(concurrency, soft_limit - 64), 1)
+
 def run_cmd_list(opts, conf, cmd_seq, show_output, capture_stderr):
-    def worker():
-        while True:
-            try:
-                item = q.get(block=False)
-            except Queue.Empty:
-                break
-            else:
-                node, cmd = item
-                output = utils.system_return_output(cmd, capture_stderr=capture_stderr)
-                data = (node, output)
-                with lock:
-                    if show_output:
-                        print "------- %s\n%s" % data,
-                    ret.append(data)
-                q.task_done()
+    """
+    Run the (node, cmd) commands of cmd_seq with up to TOOL_CONCURRENCY
+    of them at a time, multiplexing their output with poll(2) in this
+    thread.  If show_output, output is printed line by line as it
+    arrives, prefixed by the node name, followed by a summary of the
+    exit status and latency of every node; otherwise it is collected.
+    Commands that run longer than TOOL_TIMEOUT seconds are cancelled.
+    Return a list of (node, output), where output is empty for failed
+    commands unless capture_stderr.
+    """
+    def emit(c, data):
+        if show_output:
+            lines = (c.partial + data).split('\n')
+            c.partial = lines.pop()
+            for line in lines:
+                sys.stdout.write("%s: %s\n" % (c.node, line))
+            sys.stdout.flush()
+        else:
+            c.output.append(data)
+
+    def finish(c):
+        del running[c.fd]
+        if not c.eof:
+            poller.unregister(c.fd)
+        c.proc.stdout.close()
+        c.latency = time.time() - c.start
+        if c.partial:
+            emit(c, '\n')
+        output = ''.join(c.output)
+        if c.proc.returncode != 0 and not capture_stderr:
+            output = ''
+        ret.append((c.node, output))
+        done.append(c)
 
+    concurrency = get_concurrency(conf)
+    # --timeout 0 disables a TOOL_TIMEOUT from the config
+    timeout = getattr(opts, 'timeout', None)
+    if timeout is None:
+        timeout = conf.get('TOOL_TIMEOUT', '0')
+    timeout = float(timeout)
+    cmd_seq = iter(cmd_seq)
+    running = {}
     ret = []
-    q = Queue.Queue()
-    for task in cmd_seq:
-        logging.debug(task)
-        q.put(task)
-
-    lock = threading.Lock()
-    max_threads = int(conf.get('TOOL_THREADS', '64'))
-    for i in range(min(max_threads, q.qsize())):
-        t = threading.Thread(target=worker)
-        t.start()
-
-    q.join() # block until all tasks are done
+    done = []
+    poller = select.poll()
+    devnull = open(os.devnull)
+    try:
+        more = True
+        while more or running:
+            # start commands up to the concurrency limit
+            while more and len(running) < concurrency:
+                try:
+                    node, cmd = next(cmd_seq)
+                except StopIteration:
+                    more = False
+                    break
+                logging.debug((node, cmd))
+                c = Command(node, cmd, devnull, timeout)
+                running[c.fd] = c
+                poller.register(c.fd, select.POLLIN)
+            if not running:
+                break
+
+            # Wait for output, the next deadline, or at most a second
+            # (which also catches processes that exit after closing
+            # their output).
+            now = time.time()
+            wait = 1.0
+            for c in running.itervalues():
+                if c.eof:
+                    wait = min(wait, 0.05)
+                elif c.deadline is not None:
+                    wait = min(wait, max(c.deadline - now, 0))
+            for fd, event in poller.poll(wait * 1000):
+                c = running[fd]
+                try:
+                    data = os.read(fd, 65536)
+                except OSError, e:
+                    if e.errno == errno.EAGAIN:
+                        continue
+                    data = ''
+                if data:
+                    emit(c, data)
+                else:
+                    c.eof = True
+                    poller.unregister(fd)
+
+            now = time.time()
+            for c in running.values():
+                if c.proc.poll() is not None:
+                    # don't wait forever for the output of a process that
+                    # left a background child holding the pipe
+                    if c.exited_at is None:
+                        c.exited_at = now
+                    if c.eof or c.killed_at is not None or now - c.exited_at >= KILL_GRACE:
+                        finish(c)
+                elif c.deadline is not None and now >= c.deadline:
+                    if not c.timed_out:
+                        logging.warning('%s: timed out after %ds, cancelling', c.node, timeout)
+                        c.timed_out = True
+                    c.stop(now)
+                    c.deadline = now + KILL_GRACE
+    except KeyboardInterrupt:
+        logging.warning('Interrupted, cancelling %d running commands', len(running))
+        now = time.time()
+        for c in running.values():
+            c.stop(now)
+        for c in running.values():
+            while c.proc.poll() is None and time.time() < now + KILL_GRACE:
+                time.sleep(0.05)
+            if c.proc.poll() is None:
+                c.proc.kill()
+                c.proc.wait()
+        raise
+    finally:
+        devnull.close()
+
+    if show_output and done:
+        failed = [c for c in done if c.proc.returncode != 0]
+        print "------- %d hosts, %d succeeded, %d failed (%d timed out)" % (
+            len(done), len(done) - len(failed), len(failed), len([c for c in done if c.timed_out]))
+        for c in sorted(done, key=lambda c: (c.proc.returncode == 0, c.node)):
+            status = 'timeout' if c.timed_out else 'exit %d' % (c.proc.returncode,)
+            print "  %s %s %.2fs" % (c.node, status, c.latency)
     return ret
 
 def ssh(opts, conf, args):
@@ -92,6 +276,19 @@ def ssh(opts, conf, args):
 def rsync(opts, conf, args):
     run_cmd_list(opts, conf, rsync_cmd_list(opts, conf, args), show_output=True, capture_stderr=True)
 
+def warm(opts, conf, args):
+    if get_control_persist(conf) <= 0:
+        raise ValueError("warm requires SSH_CONTROL_PERSIST > 0")
+
+    # open a master connection to every instance, then show their state
+    instances = list(aws.filter_instances(opts, conf))
+    run_cmd_list(opts, conf, ssh_cmd_list(opts, conf, ['true'], instances), show_output=False, capture_stderr=True)
+    check = []
+    for i in instances:
+        node = i.public_dns_name
+        check.append((node, ssh_args(opts, conf) + ['-O', 'check', node]))
+    run_cmd_list(opts, conf, check, show_output=True, capture_stderr=True)
+
 def prune(opts, conf, args):
     def keyfunc(i):
         v = -1
@@ -106,6 +303,15 @@ def prune(opts, conf, args):
             pass
         return v
 
+    def heartbeat_rank(hb, now):
+        # same order as the ssh script below, where a node that is no
+        # longer running is one that has stopped sending heartbeats
+        if not hb or not hb.get('task_last'):
+            return -1
+        if heartbeat.is_alive(hb, conf, now):
+            return hb['task_last']
+        return 1<<32
+
     pidfile = conf.get('REMOTE_PIDFILE', 'brenda.pid')
 
     try:
@@ -123,8 +329,14 @@ def prune(opts, conf, args):
         #   if !render.pid && task_last : return BIG
         #   if render.pid && !task_last : return SMALL
         #   if !render.pid && !task_last : return SMALL
-        script = ['if', '!', '[', '-f', 'task_last', '];', 'then', 'echo', 'SMALL;', 'elif', '[', '-f', pidfile, '];', 'then', 'cat', 'task_last;', 'else', 'echo', 'BIG;', 'fi']
-        data = [(keyfunc(i), i[0]) for i in run_cmd_list(opts, conf, ssh_cmd_list(opts, conf, script), show_output=False, capture_stderr=False)]
+        heartbeats = heartbeat.get_heartbeats(conf)
+        if heartbeats is not None:
+            now = time.time()
+            data = [(heartbeat_rank(heartbeats.get(i.id), now), i.public_dns_name)
+                    for i in aws.filter_instances(opts, conf)]
+        else:
+            script = ['if', '!', '[', '-f', 'task_last', '];', 'then', 'echo', 'SMALL;', 'elif', '[', '-f', pidfile, '];', 'then', 'cat', 'task_last;', 'else', 'echo', 'BIG;', 'fi']
+            data = [(keyfunc(i), i[0]) for i in run_cmd_list(opts, conf, ssh_cmd_list(opts, conf, script), show_output=False, capture_stderr=False)]
         data.sort(reverse=True)
         print "Prune ranking data"
         for d in data:
@@ -138,7 +350,13 @@ def prune(opts, conf, args):
             if not opts.dry_run:
                 aws.shutdown_by_public_dns_name(opts, conf, shutdown_list)
 
-def perf(opts, conf, args):
+def task_counts(opts, conf, instances):
+    """
+    Generate (instance, task_count, task_last) for the instances that
+    have completed a task, from their heartbeats if HEARTBEAT_URL is
+    set, otherwise by reading their task_count and task_last files
+    over ssh.
+    """
     def task_count_last(i):
         s = i[1].split()
         try:
@@ -149,29 +367,38 @@ def perf(opts, conf, args):
         else:
             return count, last
 
+    heartbeats = heartbeat.get_heartbeats(conf)
+    if heartbeats is not None:
+        for inst in instances:
+            hb = heartbeats.get(inst.id)
+            if hb and hb.get('task_last'):
+                yield inst, hb['task_count'], hb['task_last']
+        return
+
     script = ['if', '[', '-f', 'task_count', ']', '&&', '[', '-f', 'task_last', '];', 'then', 'cat', 'task_count;', 'cat', 'task_last;', 'else', 'echo', '0;', 'fi']
-    instances = aws.filter_instances(opts, conf)
     idict = dict([(i.dns_name, i) for i in instances])
+    for i in run_cmd_list(opts, conf, ssh_cmd_list(opts, conf, script, instances), show_output=False, capture_stderr=False):
+        inst = idict.get(i[0])
+        tasks = task_count_last(i)
+        if inst and tasks:
+            yield inst, tasks[0], tasks[1]
+
+def perf(opts, conf, args):
+    instances = aws.filter_instances(opts, conf)
     sdict = aws.get_spot_request_dict(conf)
     data = {}
-    for i in run_cmd_list(opts, conf, ssh_cmd_list(opts, conf, script, instances), show_output=False, capture_stderr=False):
-        host = i[0]
-        inst = idict.get(host)
-        if inst:
-            sir = sdict.get(inst.spot_instance_request_id)
-            price = None
-            if sir:
-                price = float(sir.price)
-            tasks = task_count_last(i)
-            if tasks:
-                task_count, task_last = tasks
-                uptime = aws.get_uptime(task_last, inst.launch_time) / 3600.0
-                stat = data.setdefault(inst.instance_type, dict(n=0, uptime_sum=0.0, task_sum=0, price_sum=0.0))
-                stat['n'] += 1
-                stat['uptime_sum'] += uptime
-                stat['task_sum'] += task_count
-                if price is not None:
-                    stat['price_sum'] += price
+    for inst, task_count, task_last in task_counts(opts, conf, instances):
+        sir = sdict.get(inst.spot_instance_request_id)
+        price = None
+        if sir:
+            price = float(sir.price)
+        uptime = aws.get_uptime(task_last, inst.launch_time) / 3600.0
+        stat = data.setdefault(inst.instance_type, dict(n=0, uptime_sum=0.0, task_sum=0, price_sum=0.0))
+        stat['n'] += 1
+        stat['uptime_sum'] += uptime
+        stat['task_sum'] += task_count
+        if price is not None:
+            stat['price_sum'] += price
     tph= []
     tpd = []
     total_tasks = 0.0
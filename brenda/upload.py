@@ -0,0 +1,387 @@
+# Brenda -- Render farm tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, stat, time, threading, hashlib, json, select, struct, filecmp, logging
+from multiprocessing.pool import ThreadPool
+import boto.s3.multipart
+from brenda import aws, error, utils
+
+MB = 1024 * 1024
+
+# S3 rejects multipart uploads with parts smaller than 5 MB (except the last one)
+MIN_PART_SIZE = 5 * MB
+
+# Directory of the work dir with the upload manifest of each task message
+MANIFESTS_DIR = 'manifests'
+
+# SQS keeps a message for at most 14 days, so an older manifest is of no use
+MANIFEST_MAX_AGE = 14 * 24 * 3600
+
+class UploadConfig(object):
+    def __init__(self, conf):
+        self.threads = max(int(conf.get('UPLOAD_THREADS', '8')), 1)
+        self.part_size = max(int(conf.get('UPLOAD_PART_SIZE', '64')) * MB, MIN_PART_SIZE)
+        self.retries = int(conf.get('UPLOAD_RETRIES', conf.get('ERROR_RETRIES', '5')))
+        self.retry_pause = int(conf.get('UPLOAD_RETRY_PAUSE', '5'))
+
+def compute_etag(path, part_size):
+    """
+    Compute the ETag S3 reports for a file uploaded by upload_files: the
+    MD5 of the file, or for a multipart upload the MD5 of the part MD5s
+    followed by the number of parts.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if size <= part_size:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(MB), ''):
+                md5.update(chunk)
+            return md5.hexdigest()
+        digests = []
+        for offset in xrange(0, size, part_size):
+            md5 = hashlib.md5()
+            remaining = min(part_size, size - offset)
+            while remaining > 0:
+                chunk = f.read(min(MB, remaining))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                remaining -= len(chunk)
+            digests.append(md5.digest())
+        return "%s-%d" % (hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+
+class Manifest(object):
+    """
+    Manifest is a record of the files of a task that have already been
+    committed to the output bucket, so that a retried or restarted upload
+    only sends the missing files.  Each line is a JSON object with the
+    name, size, mtime and ETag of a committed file.  Manifests are kept
+    outside the task output directory, by the message of the task, so
+    that they outlive a node restart or a redelivery of the task; a file
+    rendered again is recognized by its ETag.
+    """
+
+    def __init__(self, path, part_size):
+        self.path = path
+        self.part_size = part_size
+        self.entries = {}
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        continue # ignore a partially written last line
+                    self.entries[e['name']] = e
+        except IOError:
+            pass
+
+    def committed(self, name, path, st):
+        e = self.entries.get(name)
+        if e is None or e['size'] != st.st_size:
+            return False
+        if e['mtime'] == st.st_mtime:
+            return True
+        return bool(e['etag']) and compute_etag(path, self.part_size) == e['etag']
+
+    def add(self, name, path, etag):
+        st = os.stat(path)
+        e = dict(name=name, size=st.st_size, mtime=st.st_mtime, etag=etag)
+        with self.lock:
+            self.entries[name] = e
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(e) + '\n')
+
+def remove_stale_manifests(manifest_dir):
+    # manifests of tasks that were deleted by another node, or expired
+    now = time.time()
+    for fn in os.listdir(manifest_dir):
+        path = os.path.join(manifest_dir, fn)
+        try:
+            if now - os.path.getmtime(path) > MANIFEST_MAX_AGE:
+                logging.debug('Removing stale upload manifest %s', fn)
+                utils.rm(path)
+        except OSError:
+            continue
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+INOTIFY_EVENT = struct.Struct('iIII')
+
+def inotify_init(path):
+    """
+    Return an inotify file descriptor watching path for files closed
+    after writing or moved into it, or None if inotify is unavailable.
+    """
+    libc = utils.get_libc()
+    try:
+        fd = libc.inotify_init1(IN_NONBLOCK)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, path, IN_CLOSE_WRITE|IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+class DirWatcher(object):
+    """
+    DirWatcher reports the files of a directory that are complete: closed
+    after writing (when inotify is available) and with a size and mtime
+    that haven't changed for stable_time seconds.  Without inotify, the
+    directory is polled and stability alone decides.
+    """
+
+    def __init__(self, path, stable_time, ignore=()):
+        self.path = path
+        self.stable_time = stable_time
+        self.ignore = ignore
+        self.seen = {}      # name -> ((size, mtime), time first seen with this size and mtime)
+        self.reported = {}  # name -> (size, mtime) when last reported
+        self.closed = set()
+        self.fd = inotify_init(path)
+        if self.fd is None:
+            logging.debug('inotify not available, polling %s', path)
+        else:
+            # files written before the watch was set up only get the stability check
+            self.closed.update(os.listdir(path))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            return
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError:
+            return
+        i = 0
+        while i + INOTIFY_EVENT.size <= len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, i)
+            i += INOTIFY_EVENT.size
+            name = buf[i:i+length].rstrip('\0')
+            i += length
+            if name:
+                self.closed.add(name)
+
+    def stable_files(self):
+        now = time.time()
+        ready = []
+        for name in os.listdir(self.path):
+            if name in self.ignore or name.endswith('.tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue # only files are uploaded, like after the render
+            sig = (st.st_size, st.st_mtime)
+            prev = self.seen.get(name)
+            if prev is None or prev[0] != sig:
+                self.seen[name] = (sig, now)
+                continue
+            if now - prev[1] < self.stable_time or self.reported.get(name) == sig:
+                continue
+            if self.fd is not None and name not in self.closed:
+                continue
+            self.reported[name] = sig
+            ready.append(name)
+        return ready
+
+def remote_matches(bucket, key_name, path, part_size):
+    """
+    Return the ETag of the object key_name if it already matches the
+    local file in size and content, otherwise None.
+    """
+    key = bucket.get_key(key_name)
+    if key is None or key.size != os.path.getsize(path):
+        return None
+    etag = compute_etag(path, part_size)
+    if key.etag.strip('"') != etag:
+        return None
+    return etag
+
+def retry_part(uconf, action, desc):
+    """
+    Retry a single upload request (a whole small file or one part of a
+    multipart upload), so that a failure doesn't restart the entire upload.
+    """
+    return error.retry_part(action, desc, 'Upload', uconf.retries, uconf.retry_pause)
+
+def upload_files(conf, bucktup, files, manifest=None, check_remote=False):
+    """
+    Upload files to the S3 output bucket in parallel.  files is a list
+    of (path, s3name) tuples, bucktup is the return tuple of
+    aws.get_s3_output_bucket.  Files larger than UPLOAD_PART_SIZE are
+    sent as multipart uploads whose parts are spread over the same
+    thread pool as the small files.
+
+    Files recorded in manifest are skipped, and every uploaded file is
+    added to it.  If check_remote is set, files missing from the manifest
+    are first compared with the object already in the bucket.
+    """
+    uconf = UploadConfig(conf)
+
+    def commit(path, s3name, etag):
+        if manifest:
+            manifest.add(s3name, path, etag)
+
+    def get_bucket():
+        # aws caches a bucket handle for each thread
+        return aws.get_s3_output_bucket(conf)[0]
+
+    def put_file(path, s3name):
+        logging.info('Uploading %s to %s', s3name, aws.format_s3_url(bucktup, s3name))
+        etag = retry_part(uconf, lambda: aws.put_s3_file((get_bucket(), bucktup[1]), path, s3name), s3name)
+        commit(path, s3name, etag)
+
+    def put_part(mp_id, key_name, path, part_num, offset, size):
+        def action():
+            mp = boto.s3.multipart.MultiPartUpload(get_bucket())
+            mp.key_name = key_name
+            mp.id = mp_id
+            with open(path, 'rb') as fp:
+                fp.seek(offset)
+                mp.upload_part_from_file(fp, part_num, size=size)
+        logging.debug('Uploading part %d of %s (%d bytes)', part_num, key_name, size)
+        retry_part(uconf, action, "%s part %d" % (key_name, part_num))
+
+    def run_job(job):
+        job[0](*job[1:])
+        return job
+
+    # split large files into parts
+    jobs = []
+    multiparts = {}
+    for path, s3name in files:
+        st = os.stat(path)
+        key_name = bucktup[1][1] + s3name
+        if manifest and manifest.committed(s3name, path, st):
+            logging.debug('Skipping %s, already uploaded', s3name)
+            continue
+        if check_remote:
+            etag = retry_part(uconf, lambda: remote_matches(bucktup[0], key_name, path, uconf.part_size), key_name)
+            if etag:
+                logging.info('Skipping %s, %s is up to date', s3name, aws.format_s3_url(bucktup, s3name))
+                commit(path, s3name, etag)
+                continue
+        size = st.st_size
+        if size <= uconf.part_size:
+            jobs.append((put_file, path, s3name))
+            continue
+        mp = retry_part(uconf, lambda: bucktup[0].initiate_multipart_upload(key_name), key_name)
+        logging.info('Uploading %s to %s in %d MB parts', s3name,
+                     aws.format_s3_url(bucktup, s3name), uconf.part_size / MB)
+        part_num = 0
+        for offset in xrange(0, size, uconf.part_size):
+            part_num += 1
+            jobs.append((put_part, mp.id, key_name, path, part_num, offset, min(uconf.part_size, size - offset)))
+        multiparts[mp.id] = [mp, part_num, path, s3name]
+
+    if not jobs:
+        return
+
+    pool = ThreadPool(min(uconf.threads, len(jobs)))
+    try:
+        for job in pool.imap_unordered(run_job, jobs):
+            # complete a multipart upload once its last part is in
+            if job[0] is put_part:
+                mp_parts = multiparts[job[1]]
+                mp_parts[1] -= 1
+                if mp_parts[1] == 0:
+                    # the ETag S3 reports, so that the file isn't read again
+                    done = retry_part(uconf, mp_parts[0].complete_upload, mp_parts[0].key_name)
+                    del multiparts[job[1]]
+                    commit(mp_parts[2], mp_parts[3], done.etag.strip('"'))
+    except Exception:
+        pool.terminate()
+        for mp, n, path, s3name in multiparts.values():
+            try:
+                mp.cancel_upload()
+            except Exception:
+                logging.exception('Failed cancelling multipart upload of %s', mp.key_name)
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+def get_output_scheme(conf):
+    url = conf.get('OUTPUT_URL')
+    if not url:
+        raise ValueError("OUTPUT_URL not defined in configuration")
+    if url.startswith('file://'):
+        return 'file'
+    return 's3'
+
+def get_output_dir(conf):
+    path = conf.get('OUTPUT_URL')[len('file://'):]
+    if not path:
+        raise ValueError("OUTPUT_URL must be a file:///PATH URL")
+    return os.path.realpath(path)
+
+def validate_output(conf):
+    if get_output_scheme(conf) == 'file':
+        output_dir = get_output_dir(conf)
+        if not os.path.isdir(output_dir):
+            utils.makedirs(output_dir)
+    else:
+        aws.get_s3_output_bucket(conf)
+
+def commit_files(conf, files, manifest=None, check_remote=False):
+    """
+    Commit files to the output backend selected by the scheme of
+    OUTPUT_URL: an S3 bucket (s3://) or a local directory (file://).
+    See upload_files for the arguments.
+    """
+    if get_output_scheme(conf) == 'file':
+        publish_files(get_output_dir(conf), files, manifest, check_remote)
+    else:
+        upload_files(conf, aws.get_s3_output_bucket(conf), files, manifest, check_remote)
+
+def publish_files(output_dir, files, manifest=None, check_remote=False):
+    """
+    Commit files to a local (or NFS mounted) output directory.  Each file
+    appears atomically under its final name, and costs no copy at all
+    when the task output directory is on the same filesystem.
+    """
+    for path, name in files:
+        st = os.stat(path)
+        if manifest and manifest.committed(name, path, st):
+            logging.debug('Skipping %s, already committed', name)
+            continue
+        dst = os.path.join(output_dir, name)
+        if check_remote and os.path.exists(dst) and (
+                os.path.samefile(path, dst) or filecmp.cmp(path, dst, shallow=False)):
+            logging.info('Skipping %s, %s is up to date', name, dst)
+        else:
+            linked = utils.publish_file(path, dst)
+            logging.info('Committed %s to %s (%s)', name, dst, 'hard link' if linked else 'copy')
+        if manifest:
+            # hashing would cost more than the commit itself
+            manifest.add(name, path, etag='')
@@ -14,7 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, subprocess, shutil, logging
+import os, errno, fcntl, subprocess, shutil, threading, ctypes, ctypes.util, logging
+import BaseHTTPServer
 
 def config_file_name():
     config = os.environ.get("BRENDA_CONFIG")
@@ -71,6 +72,90 @@ def write_atomic(path, data):
         f.write(data)
     os.rename(tmp, path)
 
+libc = None
+
+def get_libc():
+    global libc
+    if libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError:
+            return None
+    return libc
+
+def kernel_copy(fd_in, fd_out, size):
+    """
+    Copy size bytes between file descriptors inside the kernel, with
+    copy_file_range(2) or else sendfile(2).  Return False if neither is
+    available, so that the caller can fall back to a userspace copy.
+    """
+    lc = get_libc()
+    calls = []
+    if lc is not None:
+        if hasattr(lc, 'copy_file_range'):
+            f = lc.copy_file_range
+            f.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+            f.restype = ctypes.c_ssize_t
+            calls.append(lambda n: f(fd_in, None, fd_out, None, n, 0))
+        if hasattr(lc, 'sendfile'):
+            g = lc.sendfile
+            g.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+            g.restype = ctypes.c_ssize_t
+            calls.append(lambda n: g(fd_out, fd_in, None, n))
+    for call in calls:
+        copied = 0
+        while copied < size:
+            n = call(min(size - copied, 1 << 30))
+            if n < 0:
+                err = ctypes.get_errno()
+                if copied == 0 and err in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                    break # try the next call
+                raise OSError(err, os.strerror(err))
+            if n == 0:
+                break
+            copied += n
+        if copied == size:
+            return True
+        if copied:
+            raise OSError(errno.EIO, "short copy (%d of %d bytes)" % (copied, size))
+    return False
+
+def copy_file(src, dst):
+    """
+    Copy the contents of file src to dst without passing the data
+    through userspace if the kernel supports it.
+    """
+    size = os.path.getsize(src)
+    with open(src, 'rb') as fin:
+        with open(dst, 'wb') as fout:
+            if not kernel_copy(fin.fileno(), fout.fileno(), size):
+                shutil.copyfileobj(fin, fout, 1024*1024)
+            fout.flush()
+            os.fsync(fout.fileno())
+
+def publish_file(src, dst):
+    """
+    Make file src available as dst atomically: dst either doesn't exist
+    or is complete.  src is hard linked when it is on the same filesystem
+    as dst, and copied otherwise.  Return True if src was hard linked.
+    """
+    tmp = os.path.join(os.path.dirname(dst), '.%s.%d.tmp' % (os.path.basename(dst), os.getpid()))
+    rm(tmp)
+    try:
+        os.link(src, tmp)
+        linked = True
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        copy_file(src, tmp)
+        linked = False
+    try:
+        os.rename(tmp, dst)
+    except OSError:
+        rm(tmp)
+        raise
+    return linked
+
 def str_nl(s):
     if len(s) > 0 and s[-1] != '\n':
         s += '\n'
@@ -154,3 +239,22 @@ class Cd(object):
 
     def __exit__(self, *args):
         os.chdir(self._orig)
+
+class HTTPServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTPServer is the base of the HTTP servers of brenda-node, which
+    serve requests on a daemon thread so that they never block the task
+    loop, from a socket that isn't inherited by render scripts.
+    """
+
+    allow_reuse_address = True
+
+    def server_bind(self):
+        BaseHTTPServer.HTTPServer.server_bind(self)
+        flags = fcntl.fcntl(self.socket.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(self.socket.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
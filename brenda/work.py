@@ -14,8 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, sys, random, logging
-from brenda import aws
+import os, re, sys, time, random, threading, Queue, logging
+from brenda import aws, error, utils, workqueue, sizing
 
 def subframe_iterator_defined(opts):
     return opts.subdiv_x > 0 and opts.subdiv_y > 0
@@ -31,12 +31,254 @@ def subframe_iterator(opts):
                 min_y = y * yfrac
                 max_y = (y+1) * yfrac
                 yield (
-                    ('$SF_MIN_X', str(min_x)),
-                    ('$SF_MAX_X', str(max_x)),
-                    ('$SF_MIN_Y', str(min_y)),
-                    ('$SF_MAX_Y', str(max_y)),
+                    ('SF_MIN_X', str(min_x)),
+                    ('SF_MAX_X', str(max_x)),
+                    ('SF_MIN_Y', str(min_y)),
+                    ('SF_MAX_Y', str(max_y)),
                     )
 
+# cap of the exponential backoff of a failed batch request
+MAX_RETRY_PAUSE = 60
+
+# Macros that are expanded in task scripts
+FRAME_MACROS = ('JOB_NAME', 'JOB_URL', 'START', 'END', 'STEP')
+SUBFRAME_MACROS = ('SF_MIN_X', 'SF_MAX_X', 'SF_MIN_Y', 'SF_MAX_Y')
+
+class Template(object):
+    """
+    Template is a task script compiled once into a %-format string, so
+    that each task is expanded in a single pass.  Macros are written as
+    $NAME or ${NAME}.  Names that aren't macros, such as shell variables,
+    are left as they are and reported in unknown.
+
+    The macros can be split into stages that are expanded by successive
+    calls to render, e.g. frame macros once per frame, then subframe
+    macros once per subframe.  Rendering a stage other than the last one
+    returns a Template for the remaining stages.
+    """
+
+    re_macro = re.compile(r"\$(?:\{(\w+)\}|(\w+))")
+
+    def __init__(self, text, *stages):
+        # A macro of stage i is written with 2**i percent signs, so that
+        # it becomes a format specifier after the i preceding stages are
+        # rendered.  Likewise, literal percent signs are doubled once per stage.
+        self.n_stages = len(stages)
+        self.unknown = set()
+        levels = {}
+        for i, macros in enumerate(stages):
+            for name in macros:
+                levels.setdefault(name, i)
+        literal = '%' * (2 ** self.n_stages)
+        parts = []
+        pos = 0
+        for m in self.re_macro.finditer(text):
+            name = m.group(1) or m.group(2)
+            if name not in levels:
+                self.unknown.add(name)
+                continue
+            parts.append(text[pos:m.start()].replace('%', literal))
+            parts.append('%s(%s)s' % ('%' * (2 ** levels[name]), name))
+            pos = m.end()
+        parts.append(text[pos:].replace('%', literal))
+        self.fmt = ''.join(parts)
+
+    def render(self, values):
+        remaining = self.n_stages - 1
+        if remaining == 0:
+            return self.fmt % values
+        # values must survive the remaining stages
+        escape = '%' * (2 ** remaining)
+        values = dict([(k, v.replace('%', escape)) for k, v in values.iteritems()])
+        t = Template.__new__(Template)
+        t.n_stages = remaining
+        t.unknown = self.unknown
+        t.fmt = self.fmt % values
+        return t
+
+def subframe_count(opts):
+    if subframe_iterator_defined(opts):
+        return opts.subdiv_x * opts.subdiv_y
+    return 1
+
+def frame_iterator(opts):
+    for fnum in xrange(opts.start, opts.end+1, opts.step):
+        yield fnum, min(fnum + opts.step - 1, opts.end)
+
+def task_iterator(opts, conf, task_script, chunks=None):
+    """
+    Generate (start, end, script) for the tasks one at a time, so that
+    tasks can be pushed as soon as they are created.  chunks is a list
+    of (start, end) frame ranges, by default ranges of opts.step frames.
+    """
+    subframes = list(subframe_iterator(opts))
+    if subframes:
+        template = Template(task_script, FRAME_MACROS, SUBFRAME_MACROS)
+    else:
+        template = Template(task_script, FRAME_MACROS)
+    if template.unknown:
+        logging.info('Leaving unknown macros in task script unexpanded: %s',
+                     ', '.join(sorted(template.unknown)))
+
+    values = dict(
+        JOB_NAME=conf.get("JOB_NAME", "NONE"),
+        JOB_URL=conf.get("JOB_URL", "NONE"),
+        STEP="%d" % (opts.step,))
+    subframes = [dict(macro_list) for macro_list in subframes]
+    if chunks is None:
+        chunks = frame_iterator(opts)
+    for start, end in chunks:
+        values['START'] = "%d" % (start,)
+        values['END'] = "%d" % (end,)
+        if subframes:
+            frame = template.render(values)
+            for sf_values in subframes:
+                yield start, end, frame.render(sf_values)
+        else:
+            yield start, end, template.render(values)
+
+def plan_tasks(opts, conf, task_script):
+    """
+    Choose the frame ranges of the tasks so that each renders in about
+    opts.target_duration seconds, from the timing history recorded by
+    render nodes and/or sample renders run locally.
+    """
+    records = []
+    if opts.history:
+        records.extend(sizing.read_history(opts.history, conf.get('JOB_NAME', 'NONE')))
+    if opts.samples:
+        def template_fn(start, end):
+            return next(task_iterator(opts, conf, task_script, [(start, end)]))[2]
+        records.extend(sizing.sample_renders(opts, conf, template_fn, opts.samples, subframe_count(opts)))
+    if not records:
+        logging.error('--target-duration requires timing records from --history or --sample')
+        sys.exit(1)
+
+    model = sizing.CostModel(records)
+    chunks = sizing.plan_chunks(opts, model, opts.target_duration, subframe_count(opts))
+    sizes = [len(xrange(start, end+1, opts.step)) for start, end in chunks]
+    logging.info('Estimated task overhead %.1fs from %d records, splitting frames into %d tasks of %d-%d frames',
+                 model.overhead, len(records), len(chunks), min(sizes), max(sizes))
+    return chunks
+
+def shuffle_iterator(iterable, window):
+    """
+    Randomize the order of iterable while holding at most window items
+    in memory: each new item takes the place of a random item of the
+    window, which is yielded.
+    """
+    buf = []
+    for item in iterable:
+        if len(buf) < window:
+            buf.append(item)
+            continue
+        i = random.randrange(window)
+        yield buf[i]
+        buf[i] = item
+    random.shuffle(buf)
+    for item in buf:
+        yield item
+
+def batch_iterator(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def write_batch_retry(q, batch, retries, pause):
+    """
+    Write a batch of messages, resending only the entries that failed
+    (or the whole batch if the request itself failed) until all are
+    delivered or retries are exhausted.
+    """
+    pending = batch
+    attempt = 0
+    while True:
+        try:
+            result = aws.write_batch_sqs_queue(pending, q)
+        except Exception, e:
+            if error.classify(e) is None:
+                raise
+            error.retry_counts[e.__class__.__name__] += 1
+            logging.warning('Failed sending batch of %d tasks - %s', len(pending), e)
+            failed = pending
+        else:
+            failed_ids = set([e['id'] for e in result.errors])
+            for e in result.errors:
+                logging.warning('Failed sending task %s: %s %s', e['id'], e.get('error_code'), e.get('error_message'))
+            failed = [m for m in pending if m[0] in failed_ids]
+        if not failed:
+            return
+        attempt += 1
+        if attempt > retries:
+            raise ValueError("giving up sending %d tasks after %d retries" % (len(failed), retries))
+        time.sleep(error.backoff(attempt, pause, MAX_RETRY_PAUSE))
+        pending = failed
+
+class BatchWriter(object):
+    """
+    BatchWriter keeps up to n_threads SQS batch requests in flight.  The
+    backlog is bounded, so put() blocks while all threads are busy.
+    """
+
+    def __init__(self, conf, n_threads):
+        self.conf = conf
+        self.retries = int(conf.get('ERROR_RETRIES', '5'))
+        self.pause = float(conf.get('PUSH_RETRY_PAUSE', '1'))
+        self.queue = Queue.Queue(maxsize=n_threads * 2)
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.error = None
+        self.threads = []
+        for i in xrange(n_threads):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def worker(self):
+        # each thread has its own queue connection and queue object
+        q = None
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                if self.error is None:
+                    if q is None:
+                        q = workqueue.get_queue(self.conf)[0]
+                    write_batch_retry(q, batch, self.retries, self.pause)
+                    with self.lock:
+                        self.sent += len(batch)
+            except Exception, e:
+                logging.exception('Failed sending batch of %d tasks', len(batch))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def put(self, batch):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(batch)
+
+    def close(self):
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        if self.error is not None:
+            raise self.error
+
+def get_queue_conf(opts, conf):
+    # configuration of the queue of the --priority level
+    if opts.priority:
+        return workqueue.get_level_conf(conf, opts.priority)
+    return conf
+
 def push(opts, args, conf):
     # get task script
     if not opts.task_script:
@@ -56,73 +298,80 @@ def push(opts, args, conf):
         logging.error('Shebang (#!) is missing from task script: %s', opts.task_script)
         sys.exit(1)
 
-    # build tasklist
-    tasklist = []
-    for fnum in xrange(opts.start, opts.end+1, opts.step):
-        script = task_script
-        start = fnum
-        end = min(fnum + opts.step - 1, opts.end)
-        for key, value in (
-            ("$JOB_NAME", conf.get("JOB_NAME", "NONE")),
-            ("$JOB_URL", conf.get("JOB_URL", "NONE")),
-            ("$START", "%d" % (start,)),
-            ("$END", "%d" % (end,)),
-            ("$STEP", "%d" % (opts.step,))
-        ):
-            script = script.replace(key, value)
-        if subframe_iterator_defined(opts):
-            for macro_list in subframe_iterator(opts):
-                sf_script = script
-                for key, value in macro_list:
-                    sf_script = sf_script.replace(key, value)
-                tasklist.append(sf_script)
-        else:
-            tasklist.append(script)
+    # size tasks to a target duration rather than a fixed number of frames
+    chunks = None
+    if opts.target_duration:
+        chunks = plan_tasks(opts, conf, task_script)
 
-    # possibly randomize the task list
+    # Tasks are generated, randomized and batched lazily, so memory use
+    # doesn't grow with the number of tasks and pushing starts immediately.
+    tasks = task_iterator(opts, conf, task_script, chunks)
     if opts.randomize:
-        random.shuffle(tasklist)
+        tasks = shuffle_iterator(tasks, opts.random_window)
+    if chunks is None:
+        n_tasks = len(xrange(opts.start, opts.end+1, opts.step)) * subframe_count(opts)
+    else:
+        n_tasks = len(chunks) * subframe_count(opts)
 
-    # get work queue
-    q = None
+    # get work queue, and start the threads that write batches to it
+    conf = get_queue_conf(opts, conf)
+    writer = None
     if not opts.dry_run:
-        aws.create_sqs_queue(conf)
-        q, conn = aws.get_sqs_conn_queue(conf)
+        workqueue.create_queue(conf)
+        n_threads = int(utils.get_opt(opts.push_threads, conf, 'PUSH_THREADS', '16'))
+        writer = BatchWriter(conf, max(n_threads, 1))
 
-    # push work queue to sqs
-    i = 0
+    # push work queue to sqs (or any other work queue backend)
+    # Deliver up to 10 messages in a single request
+    # http://boto.cloudhackers.com/en/latest/ref/sqs.html#boto.sqs.queue.Queue.write_batch
+    script_name = {"data_type": "String", "string_value": os.path.basename(opts.task_script)}
+    subframes = subframe_count(opts)
     j = 0
-    batch = []
-    tasklist_last_index = len(tasklist)-1
-    for task in tasklist:
-        i += 1
-        j += 1
-        logging.debug("Creating task #%04d: %s", j, task.replace("\n"," "))
-        attr = {"script_name": {"data_type": "String", "string_value": os.path.basename(opts.task_script)}}
-        batch.append((str(i), task, 0, attr))
-
-        # Deliver up to 10 messages in a single request
-        # http://boto.cloudhackers.com/en/latest/ref/sqs.html#boto.sqs.queue.Queue.write_batch
-        if i%10 == 0 or tasklist.index(task) == tasklist_last_index:
-            if q and not opts.dry_run:
-                logging.info('Queueing tasks %d of %d', j, tasklist_last_index+1)
-                aws.write_batch_sqs_queue(batch, q)
-            del batch[:]
-            i = 0
+    start_time = last_report = time.time()
+    for tasklist in batch_iterator(tasks, aws.SQS_BATCH_SIZE):
+        batch = []
+        for i, (start, end, task) in enumerate(tasklist):
+            j += 1
+            logging.debug("Creating task #%04d: %s", j, task.replace("\n"," "))
+            # frame attributes let nodes record render times for --target-duration
+            attr = sizing.task_attributes(conf, start, end, opts.step, subframes)
+            attr["script_name"] = script_name
+            batch.append((str(i+1), task, 0, attr))
+        if writer:
+            writer.put(batch)
+
+        # report progress at most once per second
+        now = time.time()
+        if now - last_report >= 1.0:
+            last_report = now
+            sent = writer.sent if writer else j
+            logging.info('Queueing tasks %d of %d (%.1f tasks/s)', sent, n_tasks, sent / max(now - start_time, 0.001))
+
+    if writer:
+        writer.close()
+    elapsed = time.time() - start_time
+    logging.info('Queued %d tasks in %.1f seconds (%.1f tasks/s)', j, elapsed, j / max(elapsed, 0.001))
 
 def status(opts, args, conf):
-    q, conn = aws.get_sqs_conn_queue(conf)
+    get_queue_conf(opts, conf)
+    for level in workqueue.get_levels(conf):
+        if opts.priority and level.name != opts.priority:
+            continue
+        lconf = workqueue.get_level_conf(conf, level.name)
+        q, conn = workqueue.get_queue(lconf)
 
-    if q:
-        logging.info("%d tasks queued on %s", q.count(), aws.get_sqs_work_queue_name(conf))
+        if q:
+            logging.info("%d tasks queued on %s (%s, weight %g, priority %d)", q.count(),
+                         workqueue.get_work_queue_name(lconf), level.name, level.weight, level.priority)
 
 def reset(opts, args, conf):
-    q, conn = aws.get_sqs_conn_queue(conf)
+    conf = get_queue_conf(opts, conf)
+    q, conn = workqueue.get_queue(conf)
 
     if q:
         if opts.hard:
-            logging.info('Deleting queue %s', aws.get_sqs_work_queue_name(conf))
-            conn.delete_queue(q)
+            logging.info('Deleting queue %s', workqueue.get_work_queue_name(conf))
+            workqueue.delete_queue(conf, q, conn)
         else:
-            logging.info('Clearing queue %s', aws.get_sqs_work_queue_name(conf))
+            logging.info('Clearing queue %s', workqueue.get_work_queue_name(conf))
             q.clear()
@@ -0,0 +1,454 @@
+# Brenda -- Render farm tool for Amazon Web Services
+# Copyright (C) 2013 James Yonan <james@openvpn.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Work queue backends, selected by the scheme of the WORK_QUEUE URL:
+#
+#   sqs://QUEUE        : Amazon SQS queue
+#   sqlite:///PATH     : SQLite database file shared by the processes of a host
+#
+# Every backend returns a queue object with the subset of the boto SQS
+# Queue API that brenda uses (get_messages, write_batch,
+# change_message_visibility_batch, delete_message_batch, delete_message,
+# count and clear), and messages with the boto Message API (id,
+# receipt_handle, message_attributes, get_body, change_visibility and
+# delete), so callers don't need to know which backend they talk to.
+#
+# Besides WORK_QUEUE, the "default" priority level, WORK_QUEUES may define
+# more levels, each with its own queue, as a space separated list of
+#
+#   NAME=URL[,weight=N][,priority=N]
+#
+# brenda-work push --priority NAME pushes to the queue of a level, and
+# brenda-node receives from the queues of all levels: strictly by priority
+# (higher first), and in proportion to their weights within a priority.
+
+import os, time, json, uuid, random, sqlite3, logging
+from brenda import aws
+from brenda.error import ValueErrorRetry
+
+def get_work_queue_url(conf):
+    url = conf.get('WORK_QUEUE')
+    if not url:
+        raise ValueError("WORK_QUEUE not defined in configuration")
+    return url
+
+def get_scheme(conf):
+    url = get_work_queue_url(conf)
+    if url.startswith('sqs://'):
+        return 'sqs'
+    if url.startswith('sqlite://'):
+        return 'sqlite'
+    raise ValueError("WORK_QUEUE must be an sqs:// or sqlite:/// URL")
+
+def get_work_queue_name(conf):
+    if get_scheme(conf) == 'sqs':
+        return aws.get_sqs_work_queue_name(conf)
+    return get_sqlite_path(conf)
+
+def create_queue(conf):
+    if get_scheme(conf) == 'sqs':
+        return aws.create_sqs_queue(conf)
+    return SQLiteQueue.create(conf)
+
+def get_queue(conf):
+    """
+    Return the work queue object (or None if the queue doesn't exist) and
+    the connection it belongs to.
+    """
+    if get_scheme(conf) == 'sqs':
+        return aws.get_sqs_conn_queue(conf)
+    path = get_sqlite_path(conf)
+    if not os.path.exists(path):
+        logging.error('Queue %s does not exist', path)
+        return None, None
+    return SQLiteQueue(path), None
+
+def delete_queue(conf, q, conn):
+    if get_scheme(conf) == 'sqs':
+        conn.delete_queue(q)
+    else:
+        q.delete()
+
+# Priority levels
+
+DEFAULT_LEVEL = 'default'
+
+class Level(object):
+    def __init__(self, name, url, weight=1.0, priority=0):
+        self.name = name
+        self.url = url
+        self.weight = weight
+        self.priority = priority
+
+def get_levels(conf):
+    """
+    Return the priority levels of the configuration, the default level
+    of WORK_QUEUE first.
+    """
+    levels = [Level(DEFAULT_LEVEL, get_work_queue_url(conf),
+                    float(conf.get('WORK_QUEUE_WEIGHT', '1')))]
+    for entry in conf.get('WORK_QUEUES', '').split():
+        try:
+            name, spec = entry.split('=', 1)
+            fields = spec.split(',')
+            level = Level(name, fields[0])
+            for field in fields[1:]:
+                k, v = field.split('=', 1)
+                if k == 'weight':
+                    level.weight = float(v)
+                elif k == 'priority':
+                    level.priority = int(v)
+                else:
+                    raise ValueError(k)
+        except ValueError:
+            raise ValueError("WORK_QUEUES entries must be NAME=URL[,weight=N][,priority=N]: %s" % (entry,))
+        if level.weight <= 0:
+            raise ValueError("weight of work queue %s must be positive" % (name,))
+        if name in [l.name for l in levels]:
+            raise ValueError("work queue %s is defined twice" % (name,))
+        levels.append(level)
+    return levels
+
+def get_level_conf(conf, name):
+    """
+    Return a copy of conf whose WORK_QUEUE is the queue of level name,
+    for the functions of this module that operate on a single queue.
+    """
+    for level in get_levels(conf):
+        if level.name == name:
+            c = dict(conf)
+            c['WORK_QUEUE'] = level.url
+            return c
+    raise ValueError("unknown work queue priority level %s" % (name,))
+
+class FairQueue(object):
+    """
+    FairQueue receives messages from the queues of several priority
+    levels.  Higher priorities are served first, and levels of the same
+    priority share the receives in proportion to their weights, by the
+    virtual time (messages received / weight) of each level.
+
+    A level whose queue came up empty is skipped for empty_backoff
+    seconds, so that idle queues don't add their poll latency to every
+    receive.  The queue of a level other than the default may not exist
+    yet (nothing was pushed to it, or it was reset); such a level is
+    treated as empty and looked up again every MISSING_RECHECK seconds.
+    Received messages have a level attribute, the Level with the queue
+    object they belong to.
+    """
+
+    # seconds between lookups of the queue of a level that doesn't exist
+    MISSING_RECHECK = 60
+
+    def __init__(self, conf, empty_backoff):
+        self.conf = conf
+        self.levels = []
+        for level in get_levels(conf):
+            level.queue = None
+            level.vtime = 0.0
+            level.empty_until = 0
+            if not self.resolve(level, time.time()) and level.name == DEFAULT_LEVEL:
+                raise ValueErrorRetry("Work queue %s does not exist" % (level.url,))
+            self.levels.append(level)
+        self.empty_backoff = empty_backoff
+
+    def resolve(self, level, now):
+        # look up the queue of level, which may not have been created yet
+        level.queue = get_queue(get_level_conf(self.conf, level.name))[0]
+        if not level.queue:
+            level.queue = None
+            level.empty_until = now + self.MISSING_RECHECK
+            if level.name != DEFAULT_LEVEL:
+                logging.warning('Work queue %s of priority level %s does not exist, treating it as empty',
+                                level.url, level.name)
+        return level.queue is not None
+
+    def candidates(self, now):
+        # levels in the order in which they should be served
+        for level in self.levels:
+            if level.queue is None and level.empty_until <= now:
+                self.resolve(level, now)
+        levels = [l for l in self.levels if l.queue is not None]
+        active = [l for l in levels if l.empty_until <= now] or levels
+        random.shuffle(active) # break ties
+        return sorted(active, key=lambda l: (-l.priority, l.vtime))
+
+    def receive(self, num_messages, visibility_timeout, wait_time):
+        """
+        Receive up to num_messages, from the preferred non-empty levels.
+        Only the last level tried may wait up to wait_time seconds for
+        messages to arrive.
+        """
+        msgs = []
+        now = time.time()
+        levels = self.candidates(now)
+        if len(self.levels) > 1:
+            # don't sleep on one queue while work arrives on another
+            wait_time = min(wait_time, int(self.empty_backoff))
+        for i, level in enumerate(levels):
+            last = i == len(levels) - 1
+            got = aws.read_batch_sqs_queue(level.queue, num_messages - len(msgs),
+                                           visibility_timeout, wait_time if last else 0)
+            if not got:
+                level.empty_until = time.time() + self.empty_backoff
+                continue
+            if level.empty_until:
+                # a level that was idle doesn't get to catch up
+                level.empty_until = 0
+                busy = [l.vtime for l in self.levels if l is not level and not l.empty_until]
+                if busy:
+                    level.vtime = max(level.vtime, min(busy))
+            level.vtime += len(got) / level.weight
+            for msg in got:
+                msg.level = level
+            msgs.extend(got)
+            if len(msgs) >= num_messages:
+                break
+        return msgs
+
+def group_by_queue(msgs):
+    """
+    Return (queue, messages) for the queue of each of msgs, which were
+    received by a FairQueue.
+    """
+    groups = {}
+    for msg in msgs:
+        groups.setdefault(msg.level.name, (msg.level.queue, []))[1].append(msg)
+    return groups.values()
+
+# SQLite backend
+
+def get_sqlite_path(conf):
+    path = get_work_queue_url(conf)[len('sqlite://'):]
+    if not path:
+        raise ValueError("WORK_QUEUE must be a sqlite:///PATH URL")
+    return os.path.realpath(path)
+
+class BatchResults(object):
+    def __init__(self):
+        self.results = []
+        self.errors = []
+
+class SQLiteMessage(object):
+    def __init__(self, queue, id, receipt_handle, body, message_attributes):
+        self.queue = queue
+        self.id = id
+        self.receipt_handle = receipt_handle
+        self.body = body
+        self.message_attributes = message_attributes
+
+    def get_body(self):
+        return self.body
+
+    def change_visibility(self, visibility_timeout):
+        return self.queue.change_message_visibility(self, visibility_timeout)
+
+    def delete(self):
+        return self.queue.delete_message(self)
+
+class SQLiteQueue(object):
+    """
+    SQLiteQueue is a work queue in an SQLite database with the semantics
+    of an SQS queue: received messages are hidden for a visibility
+    timeout, and must be deleted with the receipt handle of the receive
+    before it expires or they are delivered again.  Any number of
+    processes on a host can share the database.
+    """
+
+    # interval between checks of an empty queue while long polling
+    poll_interval = 0.2
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            body TEXT NOT NULL,
+            attributes TEXT,
+            sent_at REAL NOT NULL,
+            visible_at REAL NOT NULL,
+            receipt_handle TEXT);
+        CREATE INDEX IF NOT EXISTS messages_visible_at ON messages (visible_at);
+        CREATE INDEX IF NOT EXISTS messages_sent_at ON messages (sent_at);
+        CREATE TABLE IF NOT EXISTS queue_attributes (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL);
+        """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = path
+
+    @classmethod
+    def create(cls, conf):
+        q = cls(get_sqlite_path(conf))
+        q.connection().executescript(cls.schema)
+        with q.transaction() as db:
+            for name, value in (
+                ('VisibilityTimeout', conf.get('VISIBILITY_TIMEOUT', '120')),
+                ('MessageRetentionPeriod', conf.get('MESSAGE_RETENTION', '1209600')),
+                ):
+                db.execute("INSERT OR REPLACE INTO queue_attributes VALUES (?, ?)", (name, value))
+        return q
+
+    def connection(self):
+        # one connection per process and thread, like the boto connections
+        def connect():
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            # task scripts are byte strings, as they are for SQS
+            db.text_factory = str
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            return db
+        return aws.get_cached(('sqlite', self.path), connect)
+
+    def transaction(self):
+        return Transaction(self.connection())
+
+    def get_attribute(self, db, name, default):
+        row = db.execute("SELECT value FROM queue_attributes WHERE name = ?", (name,)).fetchone()
+        return int(row[0]) if row else default
+
+    def write_batch(self, messages):
+        """
+        messages is a list of (id, body, delay_seconds, message_attributes)
+        tuples, as for boto.sqs.queue.Queue.write_batch.
+        """
+        now = time.time()
+        results = BatchResults()
+        with self.transaction() as db:
+            for id, body, delay, attributes in messages:
+                db.execute("INSERT INTO messages (body, attributes, sent_at, visible_at) VALUES (?, ?, ?, ?)",
+                           (body, json.dumps(attributes or {}), now, now + delay))
+                results.results.append({'id': id})
+        return results
+
+    def receive(self, num_messages, visibility_timeout):
+        now = time.time()
+        msgs = []
+        with self.transaction() as db:
+            if visibility_timeout is None:
+                visibility_timeout = self.get_attribute(db, 'VisibilityTimeout', 120)
+            retention = self.get_attribute(db, 'MessageRetentionPeriod', 1209600)
+            db.execute("DELETE FROM messages WHERE sent_at < ?", (now - retention,))
+            rows = db.execute("SELECT id, body, attributes FROM messages WHERE visible_at <= ? ORDER BY id LIMIT ?",
+                              (now, num_messages)).fetchall()
+            for id, body, attributes in rows:
+                receipt_handle = uuid.uuid4().hex
+                db.execute("UPDATE messages SET visible_at = ?, receipt_handle = ? WHERE id = ?",
+                           (now + visibility_timeout, receipt_handle, id))
+                msgs.append(SQLiteMessage(self, str(id), receipt_handle, body,
+                                          json.loads(attributes, object_hook=encode_strings)))
+        return msgs
+
+    def get_messages(self, num_messages=1, visibility_timeout=None, attributes=None,
+                     wait_time_seconds=None, message_attributes=None):
+        deadline = time.time() + (wait_time_seconds or 0)
+        while True:
+            msgs = self.receive(num_messages, visibility_timeout)
+            if msgs or time.time() >= deadline:
+                return msgs
+            time.sleep(self.poll_interval)
+
+    def read(self, visibility_timeout=None, wait_time_seconds=None, message_attributes=None):
+        msgs = self.get_messages(1, visibility_timeout, wait_time_seconds=wait_time_seconds)
+        if msgs:
+            return msgs[0]
+
+    def _change_visibility(self, db, msg, visibility_timeout):
+        cur = db.execute("UPDATE messages SET visible_at = ? WHERE id = ? AND receipt_handle = ?",
+                         (time.time() + visibility_timeout, int(msg.id), msg.receipt_handle))
+        return cur.rowcount == 1
+
+    def _delete(self, db, msg):
+        cur = db.execute("DELETE FROM messages WHERE id = ? AND receipt_handle = ?",
+                         (int(msg.id), msg.receipt_handle))
+        return cur.rowcount == 1
+
+    def change_message_visibility(self, msg, visibility_timeout):
+        with self.transaction() as db:
+            if not self._change_visibility(db, msg, visibility_timeout):
+                raise ValueErrorRetry("Receipt handle of message %s is invalid" % (msg.id,))
+        return True
+
+    def delete_message(self, msg):
+        with self.transaction() as db:
+            if not self._delete(db, msg):
+                raise ValueErrorRetry("Receipt handle of message %s is invalid" % (msg.id,))
+        return True
+
+    def change_message_visibility_batch(self, messages):
+        results = BatchResults()
+        with self.transaction() as db:
+            for msg, visibility_timeout in messages:
+                if self._change_visibility(db, msg, visibility_timeout):
+                    results.results.append({'id': msg.id})
+                else:
+                    results.errors.append(invalid_receipt_error(msg))
+        return results
+
+    def delete_message_batch(self, messages):
+        results = BatchResults()
+        with self.transaction() as db:
+            for msg in messages:
+                if self._delete(db, msg):
+                    results.results.append({'id': msg.id})
+                else:
+                    results.errors.append(invalid_receipt_error(msg))
+        return results
+
+    def count(self):
+        # like ApproximateNumberOfMessages, count the visible messages
+        db = self.connection()
+        return db.execute("SELECT COUNT(*) FROM messages WHERE visible_at <= ?", (time.time(),)).fetchone()[0]
+
+    def clear(self):
+        with self.transaction() as db:
+            db.execute("DELETE FROM messages")
+
+    def delete(self):
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.path + suffix)
+            except OSError:
+                pass
+
+def encode_strings(d):
+    # json object hook that returns UTF-8 byte strings instead of unicode
+    return dict((k.encode('utf-8'), v.encode('utf-8') if isinstance(v, unicode) else v)
+                for k, v in d.iteritems())
+
+def invalid_receipt_error(msg):
+    return {'id': msg.id, 'sender_fault': 'true', 'error_code': 'ReceiptHandleIsInvalid',
+            'error_message': 'The receipt handle of message %s is no longer valid' % (msg.id,)}
+
+class Transaction(object):
+    """
+    Transaction is a context manager that runs an IMMEDIATE transaction,
+    taking the database write lock up front so that concurrent receives
+    never hand out the same message.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.db.execute("COMMIT")
+        else:
+            self.db.execute("ROLLBACK")
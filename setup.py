@@ -10,7 +10,7 @@ with open('brenda/version.py') as f:
 setup(name = "Brenda",
       version = VERSION,
       packages = ['brenda'],
-      scripts = ['brenda-work', 'brenda-tool', 'brenda-run', 'brenda-node'],
+      scripts = ['brenda-work', 'brenda-tool', 'brenda-run', 'brenda-node', 'brenda-asset'],
       author = "Sen Haerens",
       author_email = "sen@senhaerens.be",
       description = "Render farm tool for cloud computing services",
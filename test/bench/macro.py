@@ -0,0 +1,63 @@
+# Microbenchmark of task script macro expansion: the compiled
+# single-pass brenda.work.Template versus repeated str.replace calls.
+#
+#   $ python test/bench/macro.py [script_lines] [tasks] [subdiv]
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from brenda import work
+
+def replace_expand(script, frame_values, subframes):
+    for key, value in frame_values:
+        script = script.replace('$' + key, value)
+    for macro_list in subframes:
+        sf_script = script
+        for key, value in macro_list:
+            sf_script = sf_script.replace('$' + key, value)
+        yield sf_script
+
+def template_expand(template, frame_values, subframes):
+    frame = template.render(dict(frame_values))
+    for macro_list in subframes:
+        yield frame.render(dict(macro_list))
+
+class Opts(object):
+    pass
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    tasks = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    subdiv = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    # one line in ten uses macros, the rest is plain shell
+    line = 'blender -b $JOB_NAME.blend -s $START -e $END -j $STEP -- $SF_MIN_X $SF_MAX_X $SF_MIN_Y $SF_MAX_Y $HOME\n'
+    plain = 'cp -a "$HOME/assets/textures" ./textures || exit 1\n'
+    script = '#!/bin/sh\n' + (line + plain * 9) * (lines // 10)
+    opts = Opts()
+    opts.subdiv_x = opts.subdiv_y = subdiv
+    subframes = list(work.subframe_iterator(opts))
+
+    def frame_values(i):
+        return (('JOB_NAME', 'job'), ('JOB_URL', 'NONE'), ('START', str(i)), ('END', str(i)), ('STEP', '1'))
+
+    t = time.time()
+    for i in xrange(tasks):
+        for s in replace_expand(script, frame_values(i), subframes):
+            pass
+    t_replace = time.time() - t
+
+    t = time.time()
+    template = work.Template(script, work.FRAME_MACROS, work.SUBFRAME_MACROS)
+    for i in xrange(tasks):
+        for s in template_expand(template, frame_values(i), subframes):
+            pass
+    t_template = time.time() - t
+
+    n = tasks * len(subframes)
+    print "%d tasks, %d line script" % (n, lines)
+    print "  str.replace : %.3f s (%.0f tasks/s)" % (t_replace, n / t_replace)
+    print "  Template    : %.3f s (%.0f tasks/s)" % (t_template, n / t_template)
+    print "  speedup     : %.1fx" % (t_replace / t_template,)
+
+main()